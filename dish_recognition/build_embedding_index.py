@@ -0,0 +1,74 @@
+"""
+向量索引构建脚本
+重新构建指定模型（食堂）的向量索引：默认用该模型已记录的参考图片重新提取特征，
+指定训练目录时用目录中的全部训练图片作为参考图片
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import argparse
+import re
+from config import UPLOAD_CONFIG, EMBEDDING_CONFIG, MODEL_REGISTRY_CONFIG
+from embedding_index import EmbeddingMatcher, create_extractor
+
+
+UNIQUE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def dish_code_from_filename(filename: str):
+    """
+    从训练图片文件名中解析菜品码
+    文件名为 train_{YYYYmmdd_HHMMSS}_{唯一ID}_{dish_code}.ext，兼容不带唯一ID的旧文件名
+    """
+    stem = os.path.splitext(filename)[0]
+    if not stem.startswith("train_"):
+        return None
+    parts = stem[len("train_"):].split("_", 3)
+    if len(parts) < 3:
+        return None
+    if len(parts) == 4 and UNIQUE_ID.match(parts[2]):
+        return parts[3]
+    return "_".join(parts[2:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重新构建模型的向量索引")
+    parser.add_argument("--model-id", default=MODEL_REGISTRY_CONFIG["default_model_id"], help="模型（食堂）ID")
+    parser.add_argument("--training-dir", default=None,
+                        help="训练图片目录，指定时用目录中全部训练图片作为参考图片")
+    args = parser.parse_args()
+
+    model = None
+    if EMBEDDING_CONFIG["extractor"] == "yolo":
+        from model_handler import get_model
+        model = get_model(args.model_id).model
+
+    extractor = create_extractor(model)
+    if extractor is None:
+        print("没有可用的特征提取器（YOLO模型未加载），请检查模型权重或改用histogram特征")
+        return
+
+    matcher = EmbeddingMatcher(extractor, args.model_id)
+    if args.training_dir:
+        items = []
+        allowed = UPLOAD_CONFIG["allowed_extensions"]
+        for filename in sorted(os.listdir(args.training_dir)):
+            if os.path.splitext(filename)[1].lower() not in allowed:
+                continue
+            dish_code = dish_code_from_filename(filename)
+            if dish_code:
+                items.append((os.path.join(args.training_dir, filename), dish_code))
+    else:
+        items = [(path, code) for path, code in matcher.index.reference_images() if os.path.exists(path)]
+
+    # 清空已有索引后重新构建
+    matcher.index.reset_files()
+    matcher = EmbeddingMatcher(extractor, args.model_id)
+
+    print(f"模型 {args.model_id} 共 {len(items)} 张参考图片，开始提取特征...")
+    matcher.add_references(items)
+    print(f"向量索引构建完成，共 {len(matcher.index)} 个参考向量")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,35 @@ MODEL_CONFIG = {
     "conf_threshold": 0.5,  # 置信度阈值
     "iou_threshold": 0.5,   # NMS IOU阈值
     "max_det": 10,          # 最大检测数量
+    # 推理后端："yolo" 使用真实模型（加载失败时回退到合成后端），"synthetic" 直接使用合成后端
+    "backend": os.environ.get("DISH_MODEL_BACKEND", "yolo"),
+}
+
+# 多模型注册表配置（每个食堂一个模型）
+MODEL_REGISTRY_CONFIG = {
+    "default_model_id": "default",
+    "model_id_header": "X-Model-Id",   # 也可通过表单参数model_id指定
+    "memory_budget_mb": 2048,          # 已加载模型的总内存预算，超出时按LRU淘汰
+    "preload": ["default"],            # 服务启动时预加载的模型
+    # 已注册的模型；未列出的model_id按 models/<model_id>/weights.pt 和 class_map.json 查找
+    # class_map: 模型类别名 -> 菜品码
+    "models": {
+        "default": {"model_path": MODEL_CONFIG["model_path"], "class_map": {}},
+    },
+}
+
+# 合成推理后端配置（容量测试用）
+SYNTHETIC_BACKEND_CONFIG = {
+    "seed": int(os.environ.get("DISH_SYNTHETIC_SEED", "0")),
+    # 单张图片耗时，对数正态分布（毫秒）
+    "latency_ms": {"median": 45.0, "sigma": 0.25, "min": 5.0, "max": 500.0},
+    "batch_overhead_ms": 8.0,   # 每个批次的固定开销
+    "batch_efficiency": 0.6,    # 批次中第二张起每张图片的耗时系数
+    # 每个批次耗时中占用CPU的比例，其余时间休眠；按Beta分布采样，concentration越大越集中于mean
+    "cpu_fraction": {"mean": 0.7, "concentration": 20.0},
+    "detections": {"min": 1, "max": 3},
+    "confidence": [0.7, 0.99],
+    "default_size": [640, 640], # 无法解析图片尺寸时使用
 }
 
 # 数据库配置
@@ -35,6 +64,28 @@ DATABASE_CONFIG = {
     "validation_split": 0.2,
 }
 
+# 向量最近邻匹配配置（识别第二阶段）
+EMBEDDING_CONFIG = {
+    "enabled": False,               # 默认关闭，配置好参考图片并验证效果后再开启
+    "extractor": "yolo",            # "yolo" YOLO骨干网络特征，"histogram" 颜色直方图（区分度低，仅供测试）
+    "crop_size": 64,                # 裁剪图缩放尺寸
+    "histogram_bins": 8,            # 每个颜色通道的分箱数，特征维度为其立方
+    "batch_size": 32,               # 每批提取特征的裁剪图数量
+    "similarity_threshold": 0.92,   # 余弦相似度达到该值，且高于检测置信度时才采用向量匹配结果
+    "min_margin": 0.05,             # 最相似菜品需领先次相似菜品的相似度差值
+    # 每个模型一份参考向量：<index_dir>/<model_id>/ 下的 vectors.f32（float32原始向量，可内存映射）、
+    # labels.jsonl 和 meta.json
+    "index_dir": os.path.join(DATA_DIR, "embeddings"),
+}
+
+# 训练图片去重配置
+DEDUP_CONFIG = {
+    "index_path": os.path.join(DATA_DIR, "training_phash.json"),  # 感知哈希缓存
+    "hash_size": 8,          # dHash边长，哈希位数为 hash_size * hash_size
+    "max_distance": 6,       # 汉明距离不超过该值视为近似重复
+    "on_duplicate": "skip",  # 入库时发现近似重复："skip" 拒绝保存，"flag" 保存并在响应中标记
+}
+
 # API配置
 API_CONFIG = {
     "host": "0.0.0.0",
@@ -49,6 +100,50 @@ UPLOAD_CONFIG = {
     "allowed_extensions": {".jpg", ".jpeg", ".png", ".bmp", ".webp"},
     "max_file_size": 10 * 1024 * 1024,  # 10MB
     "upload_directory": UPLOADS_DIR,
+    "chunk_size": 64 * 1024,            # 分块读取大小
+    "max_form_overhead": 64 * 1024,     # 请求体中文件以外的表单字段和分隔符开销上限
+    "header_probe_size": 256 * 1024,    # 解析图片尺寸时最多缓存的文件头字节数
+    "max_image_dimension": 8192,        # 图片最大边长（像素）
+}
+
+# 标注图渲染缓存配置
+RENDER_CONFIG = {
+    "cache_dir": os.path.join(DATA_DIR, "render_cache"),
+    "max_cache_mb": 512,      # 缓存总大小上限，超出时按LRU淘汰
+    "thumbnail_size": 320,    # 缩略图最长边
+    "jpeg_quality": 85,
+    "webp_quality": 80,
+    "cache_max_age": 86400,   # 响应的Cache-Control max-age（秒）
+    "stream_chunk_size": 64 * 1024,  # 返回标注图时每次读取的字节数
+    "max_records": 10000,     # 内存中保留的检测记录数，超出时淘汰最久未访问的记录
+}
+
+# 菜品消费统计配置
+STATS_CONFIG = {
+    "checkpoint_path": os.path.join(DATA_DIR, "dish_stats.npz"),
+    "checkpoint_interval": 60,  # 检查点间隔（秒）
+    # 滚动窗口：名称 -> (每桶秒数, 桶数)
+    "windows": {
+        "minute": (60, 60),     # 最近60分钟，按分钟
+        "hour": (3600, 24),     # 最近24小时，按小时
+        "day": (86400, 30),     # 最近30天，按天
+    },
+    # 餐次（本地时间，[开始小时, 结束小时)）
+    "meal_periods": {"breakfast": [6, 10], "lunch": [10, 14], "dinner": [16, 21]},
+    "meal_days": 30,            # 餐次计数保留天数
+}
+
+# 推理调度配置
+SCHEDULER_CONFIG = {
+    "priorities": {"high": 0, "normal": 1, "low": 2},  # 数值越小越先执行
+    "default_priority": "normal",
+    "training_priority": "low",               # 添加训练数据时提取参考向量使用的优先级
+    "priority_header": "X-Priority",          # 指定优先级的请求头
+    "deadline_header": "X-Deadline-Ms",       # 相对截止时间（毫秒）请求头
+    "api_key_header": "X-API-Key",
+    "api_key_priorities": {},                 # API Key到优先级的映射，如 {"checkout-lane-key": "high"}
+    "max_queue_size": 256,
+    "workers": 1,                             # 推理线程数（共享同一模型）
 }
 
 # 菜品类别映射（示例）
@@ -81,9 +176,16 @@ def get_config() -> Dict[str, Any]:
     """获取完整配置"""
     return {
         "model": MODEL_CONFIG,
+        "model_registry": MODEL_REGISTRY_CONFIG,
+        "synthetic_backend": SYNTHETIC_BACKEND_CONFIG,
         "database": DATABASE_CONFIG,
+        "dedup": DEDUP_CONFIG,
+        "embedding": EMBEDDING_CONFIG,
         "api": API_CONFIG,
         "upload": UPLOAD_CONFIG,
+        "scheduler": SCHEDULER_CONFIG,
+        "stats": STATS_CONFIG,
+        "render": RENDER_CONFIG,
         "categories": DISH_CATEGORIES,
         "default_dishes": DEFAULT_DISHES
     }
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+训练数据去重脚本
+按感知哈希清理训练目录中的近似重复图片，每组保留最早的一张
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import argparse
+import shutil
+from config import DATA_DIR, DEDUP_CONFIG
+from phash_index import BKTree, TrainingImageIndex
+
+
+def find_duplicate_groups(index: TrainingImageIndex, max_distance: int):
+    """
+    按文件名顺序（包含时间戳）扫描，与已保留图片近似重复的归入其分组
+    返回 {保留文件名: [重复文件名, ...]}
+    """
+    kept = BKTree()
+    groups = {}
+    for filename in sorted(index.entries):
+        hash_value = index.hash_of(filename)
+        matches = kept.search(hash_value, max_distance)
+        if matches:
+            groups[matches[0][1]].append(filename)
+        else:
+            kept.add(hash_value, filename)
+            groups[filename] = []
+    return {name: dups for name, dups in groups.items() if dups}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="清理训练目录中的近似重复图片")
+    parser.add_argument("--max-distance", type=int, default=DEDUP_CONFIG["max_distance"],
+                        help="汉明距离阈值，不超过该值视为近似重复")
+    parser.add_argument("--move-to", default=os.path.join(DATA_DIR, "training_duplicates"),
+                        help="重复图片移动到的目录")
+    parser.add_argument("--delete", action="store_true", help="直接删除重复图片而不是移动")
+    parser.add_argument("--dry-run", action="store_true", help="只列出重复图片，不做修改")
+    args = parser.parse_args()
+
+    index = TrainingImageIndex()
+    groups = find_duplicate_groups(index, args.max_distance)
+    total = sum(len(dups) for dups in groups.values())
+    print(f"共 {len(index.entries)} 张训练图片，发现 {total} 张近似重复图片")
+
+    for keep, dups in groups.items():
+        print(f"保留 {keep}")
+        for filename in dups:
+            print(f"  重复 {filename}")
+
+    if args.dry_run or total == 0:
+        return
+
+    if not args.delete:
+        os.makedirs(args.move_to, exist_ok=True)
+    for dups in groups.values():
+        for filename in dups:
+            path = os.path.join(index.training_dir, filename)
+            if args.delete:
+                os.remove(path)
+            else:
+                shutil.move(path, os.path.join(args.move_to, filename))
+            with index.lock:
+                index.entries.pop(filename, None)
+
+    with index.lock:
+        index.rebuild_tree()
+    index.save_index()
+    print(f"已{'删除' if args.delete else '移动'} {total} 张重复图片")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+菜品消费统计
+每次识别时增量更新各菜品的滚动时间窗口计数（按分钟、小时、天及餐次），
+计数保存在环形数组中，聚合查询为常数时间，并定期写入检查点
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import threading
+import time
+from typing import Dict, Any, List, Optional
+import numpy as np
+from config import STATS_CONFIG
+
+
+class RollingWindow:
+    """
+    滚动时间窗口计数器
+    counts为(菜品数, 桶数)的环形数组，totals维护整个窗口内的合计，
+    时间前进时清空过期的桶并从合计中扣除
+    """
+    def __init__(self, bucket_seconds: int, num_buckets: int, capacity: int = 16):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.counts = np.zeros((capacity, num_buckets), dtype=np.int64)
+        self.totals = np.zeros(capacity, dtype=np.int64)
+        self.head = None   # 当前桶的绝对编号
+
+    def ensure_capacity(self, capacity: int):
+        if capacity <= len(self.totals):
+            return
+        capacity = max(capacity, 2 * len(self.totals))
+        counts = np.zeros((capacity, self.num_buckets), dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        totals = np.zeros(capacity, dtype=np.int64)
+        totals[:len(self.totals)] = self.totals
+        self.counts, self.totals = counts, totals
+
+    def advance(self, bucket: int):
+        """前进到指定桶，清空其间过期的桶"""
+        if self.head is None:
+            self.head = bucket
+            return
+        steps = bucket - self.head
+        if steps <= 0:
+            return
+        if steps >= self.num_buckets:
+            self.counts[:] = 0
+            self.totals[:] = 0
+        else:
+            for b in range(self.head + 1, bucket + 1):
+                slot = b % self.num_buckets
+                self.totals -= self.counts[:, slot]
+                self.counts[:, slot] = 0
+        self.head = bucket
+
+    def add(self, dish_idx: int, bucket: int, count: int = 1):
+        """在指定桶中累加计数（早于窗口的记录直接忽略）"""
+        self.advance(bucket)
+        if bucket <= self.head - self.num_buckets:
+            return
+        self.counts[dish_idx, bucket % self.num_buckets] += count
+        self.totals[dish_idx] += count
+
+    def current(self, dish_idx: int) -> int:
+        """当前桶的计数"""
+        return int(self.counts[dish_idx, self.head % self.num_buckets]) if self.head is not None else 0
+
+    def series(self, dish_idx: int) -> List[int]:
+        """按时间顺序返回窗口内各桶的计数（最后一个为当前桶）"""
+        if self.head is None:
+            return [0] * self.num_buckets
+        start = (self.head + 1) % self.num_buckets
+        return np.roll(self.counts[dish_idx], -start).tolist()
+
+
+class DishStats:
+    """菜品滚动统计"""
+    def __init__(self):
+        self.checkpoint_path = STATS_CONFIG["checkpoint_path"]
+        self.checkpoint_interval = STATS_CONFIG["checkpoint_interval"]
+        self.meal_periods = STATS_CONFIG["meal_periods"]
+        self.lock = threading.Lock()
+        self.dish_codes = []
+        self.dish_ids = {}
+        self.windows = {
+            name: RollingWindow(seconds, buckets)
+            for name, (seconds, buckets) in STATS_CONFIG["windows"].items()
+        }
+        # 每个餐次一个按天分桶的窗口
+        self.meal_windows = {
+            meal: RollingWindow(86400, STATS_CONFIG["meal_days"])
+            for meal in self.meal_periods
+        }
+        self.last_checkpoint = time.time()
+        self._checkpoint_thread = None
+        self.load_checkpoint()
+
+    def _all_windows(self):
+        return list(self.windows.items()) + [(f"meal_{m}", w) for m, w in self.meal_windows.items()]
+
+    def _dish_idx(self, dish_code: str) -> int:
+        idx = self.dish_ids.get(dish_code)
+        if idx is None:
+            idx = len(self.dish_codes)
+            self.dish_ids[dish_code] = idx
+            self.dish_codes.append(dish_code)
+            for _, window in self._all_windows():
+                window.ensure_capacity(idx + 1)
+        return idx
+
+    @staticmethod
+    def local_seconds(timestamp: float):
+        """
+        返回本地时间的秒数（用于分桶）和对应的struct_time
+        每次按时间戳取当时的UTC偏移，夏令时切换前后分桶与餐次判断一致
+        """
+        lt = time.localtime(timestamp)
+        return timestamp + lt.tm_gmtoff, lt
+
+    def meal_of(self, timestamp: float) -> Optional[str]:
+        """根据本地时间判断餐次"""
+        return self._meal_of_hour(time.localtime(timestamp).tm_hour)
+
+    def _meal_of_hour(self, hour: int) -> Optional[str]:
+        for meal, (start, end) in self.meal_periods.items():
+            if start <= hour < end:
+                return meal
+        return None
+
+    def record(self, dish_codes: List[str], timestamp: Optional[float] = None):
+        """记录一次识别中检测到的菜品"""
+        timestamp = timestamp or time.time()
+        local, lt = self.local_seconds(timestamp)
+        meal = self._meal_of_hour(lt.tm_hour)
+        with self.lock:
+            for dish_code in dish_codes:
+                idx = self._dish_idx(dish_code)
+                for window in self.windows.values():
+                    window.add(idx, int(local // window.bucket_seconds))
+                if meal is not None:
+                    window = self.meal_windows[meal]
+                    window.add(idx, int(local // window.bucket_seconds))
+        self.maybe_checkpoint()
+
+    def _advance_all(self):
+        """将所有窗口前进到当前时间（需持有锁）"""
+        local, _ = self.local_seconds(time.time())
+        for _, window in self._all_windows():
+            window.advance(int(local // window.bucket_seconds))
+
+    def _dish_summary(self, idx: int) -> Dict[str, Any]:
+        summary = {"dish_code": self.dish_codes[idx]}
+        for name, window in self.windows.items():
+            summary[name] = {
+                "current": window.current(idx),
+                "window_total": int(window.totals[idx]),
+            }
+        summary["meals_today"] = {meal: w.current(idx) for meal, w in self.meal_windows.items()}
+        return summary
+
+    def get_dish_stats(self, dish_code: str, series: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """获取单个菜品的统计，series指定时附带该窗口的逐桶计数"""
+        with self.lock:
+            idx = self.dish_ids.get(dish_code)
+            if idx is None:
+                return None
+            self._advance_all()
+            summary = self._dish_summary(idx)
+            if series in self.windows:
+                summary["series"] = {series: self.windows[series].series(idx)}
+            elif series in self.meal_windows:
+                summary["series"] = {series: self.meal_windows[series].series(idx)}
+            return summary
+
+    def get_summary(self) -> Dict[str, Any]:
+        """获取所有菜品的统计"""
+        with self.lock:
+            self._advance_all()
+            dishes = [self._dish_summary(idx) for idx in range(len(self.dish_codes))]
+            totals = {
+                name: int(window.totals[:len(self.dish_codes)].sum())
+                for name, window in self.windows.items()
+            }
+        return {
+            "windows": {
+                name: {"bucket_seconds": w.bucket_seconds, "buckets": w.num_buckets}
+                for name, w in self.windows.items()
+            },
+            "meal_periods": self.meal_periods,
+            "totals": totals,
+            "dishes": dishes,
+        }
+
+    def maybe_checkpoint(self):
+        """距上次检查点超过间隔时在后台线程写入检查点"""
+        if time.time() - self.last_checkpoint < self.checkpoint_interval:
+            return
+        if self._checkpoint_thread is not None and self._checkpoint_thread.is_alive():
+            return
+        self.last_checkpoint = time.time()
+        self._checkpoint_thread = threading.Thread(target=self.save_checkpoint, daemon=True)
+        self._checkpoint_thread.start()
+
+    def save_checkpoint(self):
+        """保存统计检查点"""
+        try:
+            with self.lock:
+                arrays = {"dish_codes": np.array(self.dish_codes, dtype=str)}
+                for name, window in self._all_windows():
+                    n = len(self.dish_codes)
+                    arrays[f"{name}__counts"] = window.counts[:n].copy()
+                    arrays[f"{name}__head"] = np.array(-1 if window.head is None else window.head)
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            tmp_path = self.checkpoint_path + ".tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.checkpoint_path)
+        except Exception as e:
+            print(f"保存统计检查点失败: {str(e)}")
+
+    def load_checkpoint(self):
+        """从检查点恢复统计，配置变化的窗口不恢复"""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        try:
+            with np.load(self.checkpoint_path) as data:
+                for code in data["dish_codes"].tolist():
+                    self._dish_idx(code)
+                n = len(self.dish_codes)
+                for name, window in self._all_windows():
+                    key = f"{name}__counts"
+                    if key not in data or data[key].shape != (n, window.num_buckets):
+                        continue
+                    head = int(data[f"{name}__head"])
+                    window.counts[:n] = data[key]
+                    window.totals[:n] = window.counts[:n].sum(axis=1)
+                    window.head = None if head < 0 else head
+            with self.lock:
+                self._advance_all()
+            print(f"从 {self.checkpoint_path} 恢复菜品统计，共 {len(self.dish_codes)} 个菜品")
+        except Exception as e:
+            print(f"加载统计检查点失败: {str(e)}")
+
+
+# 全局统计实例
+dish_stats = DishStats()
+
+def get_dish_stats():
+    """获取菜品统计实例"""
+    return dish_stats
@@ -0,0 +1,365 @@
+"""
+菜品向量索引
+对检测框裁剪图提取特征向量，与各菜品的参考向量做最近邻匹配
+新菜品只需加入参考图片即可识别，无需重新训练检测模型
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import json
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+from PIL import Image, ImageOps
+from config import EMBEDDING_CONFIG
+
+
+class HistogramExtractor:
+    """
+    颜色直方图特征
+    所有裁剪图缩放到同一尺寸后整批计算RGB联合直方图，不依赖模型权重
+    区分度有限（颜色相近的不同菜品相似度很高），仅用于无模型权重时的测试
+    """
+    name = "histogram"
+
+    def __init__(self):
+        self.crop_size = EMBEDDING_CONFIG["crop_size"]
+        self.bins = EMBEDDING_CONFIG["histogram_bins"]
+        self.dim = self.bins ** 3
+
+    def extract(self, crops: List[Image.Image]) -> np.ndarray:
+        """批量提取特征，返回L2归一化的(N, dim)矩阵"""
+        if not crops:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        size = (self.crop_size, self.crop_size)
+        batch = np.stack([np.asarray(crop.convert("RGB").resize(size, Image.BILINEAR)) for crop in crops])
+        quantized = (batch.astype(np.int32) * self.bins) >> 8
+        codes = (quantized[..., 0] * self.bins + quantized[..., 1]) * self.bins + quantized[..., 2]
+        codes = codes.reshape(len(crops), -1)
+        # 每张裁剪图的编码加上偏移后一次bincount完成整批统计
+        offsets = (np.arange(len(crops)) * self.dim)[:, None]
+        hist = np.bincount((codes + offsets).ravel(), minlength=len(crops) * self.dim)
+        hist = np.sqrt(hist.reshape(len(crops), self.dim).astype(np.float32))
+        return normalize(hist)
+
+
+class YoloEmbeddingExtractor:
+    """YOLO骨干网络特征，对整批裁剪图调用一次model.embed"""
+    name = "yolo"
+
+    def __init__(self, model):
+        self.model = model
+        self.crop_size = EMBEDDING_CONFIG["crop_size"]
+        self.dim = None
+
+    def extract(self, crops: List[Image.Image]) -> np.ndarray:
+        if not crops:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        # ultralytics接收BGR格式的numpy数组
+        sources = [np.asarray(crop.convert("RGB"))[:, :, ::-1] for crop in crops]
+        embeddings = self.model.embed(sources, imgsz=self.crop_size, verbose=False)
+        vectors = np.stack([e.detach().cpu().numpy().ravel() for e in embeddings]).astype(np.float32)
+        self.dim = vectors.shape[1]
+        return normalize(vectors)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """按行L2归一化"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def create_extractor(model=None):
+    """
+    根据配置创建特征提取器
+    配置为yolo但模型不可用（如合成后端）时返回None，不回退到颜色直方图
+    """
+    if EMBEDDING_CONFIG["extractor"] == "histogram":
+        return HistogramExtractor()
+    if model is not None and hasattr(model, "embed"):
+        return YoloEmbeddingExtractor(model)
+    return None
+
+
+class EmbeddingIndex:
+    """
+    参考向量最近邻索引
+    向量以float32原始格式追加写入文件，启动时直接内存映射，无需解析
+    新增向量保存在内存中的可增长区段，查询时两段一起做矩阵乘法
+    """
+    def __init__(self, index_dir: str, extractor_name: str, dim: Optional[int] = None):
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.labels_path = os.path.join(index_dir, "labels.jsonl")
+        self.meta_path = os.path.join(index_dir, "meta.json")
+        self.extractor_name = extractor_name
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.dish_codes = []       # 标签编号 -> 菜品码
+        self.dish_ids = {}         # 菜品码 -> 标签编号
+        self._base = None          # 内存映射区段
+        self._base_labels = np.zeros(0, dtype=np.int32)
+        self._tail = None          # 内存中新增区段
+        self._tail_labels = np.zeros(0, dtype=np.int32)
+        self._tail_count = 0
+        self.load_index()
+
+    def __len__(self):
+        base = 0 if self._base is None else len(self._base)
+        return base + self._tail_count
+
+    def memory_bytes(self) -> int:
+        """内存中新增区段占用的字节数（内存映射区段由系统页缓存管理，不计入）"""
+        with self.lock:
+            if self._tail is None:
+                return 0
+            return self._tail.nbytes + self._tail_labels.nbytes
+
+    def load_index(self):
+        """内存映射加载已持久化的参考向量"""
+        if not os.path.exists(self.meta_path):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta["extractor"] != self.extractor_name or (self.dim and meta["dim"] != self.dim):
+                print(f"向量索引特征类型不一致（{meta['extractor']}），重新建立索引")
+                self.reset_files()
+                return
+            self.dim = meta["dim"]
+
+            # 记录每条标签的结束位置，写入中断的残缺行及其后内容不读取
+            labels, offsets = [], []
+            if os.path.exists(self.labels_path):
+                with open(self.labels_path, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        try:
+                            labels.append(json.loads(line)["dish_code"])
+                        except (ValueError, KeyError):
+                            break
+                        offsets.append(f.tell())
+            rows = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+            count = min(rows, len(labels))
+            # 两个文件不是原子写入，中断后截断到一致的长度，避免之后追加的向量与标签错位
+            self._truncate(count, offsets[count - 1] if count else 0)
+            if count == 0:
+                return
+            self._base = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+            self._base_labels = np.array([self._label_id(code) for code in labels[:count]], dtype=np.int32)
+            print(f"向量索引已加载，共 {count} 个参考向量，{len(self.dish_codes)} 个菜品")
+        except Exception as e:
+            print(f"加载向量索引失败: {str(e)}")
+            self._base = None
+
+    def _truncate(self, count: int, labels_size: int):
+        """将向量文件和标签文件截断到前count条"""
+        vectors_size = count * self.dim * 4
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > vectors_size:
+            print(f"向量文件存在未配对的数据，截断到 {count} 条")
+            os.truncate(self.vectors_path, vectors_size)
+        if os.path.exists(self.labels_path) and os.path.getsize(self.labels_path) > labels_size:
+            print(f"标签文件存在未配对的数据，截断到 {count} 条")
+            os.truncate(self.labels_path, labels_size)
+
+    def reset_files(self):
+        """清空持久化文件"""
+        for path in (self.vectors_path, self.labels_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _label_id(self, dish_code: str) -> int:
+        if dish_code not in self.dish_ids:
+            self.dish_ids[dish_code] = len(self.dish_codes)
+            self.dish_codes.append(dish_code)
+        return self.dish_ids[dish_code]
+
+    def reference_images(self) -> List[Tuple[str, str]]:
+        """返回已持久化的参考图片列表(图片路径, 菜品码)，用于重建索引"""
+        if not os.path.exists(self.labels_path):
+            return []
+        items = []
+        with open(self.labels_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry.get("image"):
+                        items.append((entry["image"], entry["dish_code"]))
+        return items
+
+    def add(self, vectors: np.ndarray, dish_codes: List[str], images: Optional[List[str]] = None):
+        """增量加入参考向量并追加写入文件，images为对应的参考图片路径"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            if not os.path.exists(self.meta_path):
+                os.makedirs(os.path.dirname(self.meta_path), exist_ok=True)
+                with open(self.meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({"extractor": self.extractor_name, "dim": self.dim}, f)
+
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.labels_path, 'a', encoding='utf-8') as f:
+                for code, image in zip(dish_codes, images or [None] * len(dish_codes)):
+                    f.write(json.dumps({"dish_code": code, "image": image}, ensure_ascii=False) + "\n")
+
+            # 容量不足时按倍数扩容，避免每次追加都复制整个矩阵
+            needed = self._tail_count + len(vectors)
+            if self._tail is None or needed > len(self._tail):
+                capacity = max(needed, 2 * (0 if self._tail is None else len(self._tail)), 64)
+                tail = np.empty((capacity, self.dim), dtype=np.float32)
+                labels = np.empty(capacity, dtype=np.int32)
+                if self._tail is not None:
+                    tail[:self._tail_count] = self._tail[:self._tail_count]
+                    labels[:self._tail_count] = self._tail_labels[:self._tail_count]
+                self._tail, self._tail_labels = tail, labels
+            self._tail[self._tail_count:needed] = vectors
+            self._tail_labels[self._tail_count:needed] = [self._label_id(code) for code in dish_codes]
+            self._tail_count = needed
+
+    def search(self, queries: np.ndarray) -> List[Tuple[Optional[str], float, Optional[float]]]:
+        """
+        为每个查询向量返回(最相似的菜品码, 余弦相似度, 次相似的其他菜品的相似度)
+        相似度按菜品取该菜品所有参考向量中的最大值；只有一个菜品时次相似度为None
+        """
+        if len(queries) == 0:
+            return []
+        with self.lock:
+            segments = []
+            if self._base is not None:
+                segments.append((self._base, self._base_labels))
+            if self._tail_count:
+                segments.append((self._tail[:self._tail_count], self._tail_labels[:self._tail_count]))
+            dish_codes = list(self.dish_codes)
+        if not segments:
+            return [(None, 0.0, None)] * len(queries)
+
+        queries = np.asarray(queries, dtype=np.float32)
+        per_dish = np.full((len(queries), len(dish_codes)), -np.inf, dtype=np.float32)
+        for vectors, labels in segments:
+            sims = queries @ vectors.T
+            # 按标签排序后用reduceat一次求出每个菜品的最大相似度
+            order = np.argsort(labels, kind="stable")
+            sorted_labels = labels[order]
+            starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+            group_max = np.maximum.reduceat(sims[:, order], starts, axis=1)
+            group_labels = sorted_labels[starts]
+            per_dish[:, group_labels] = np.maximum(per_dish[:, group_labels], group_max)
+
+        rows = np.arange(len(queries))
+        best = per_dish.argmax(axis=1)
+        best_sim = per_dish[rows, best]
+        if len(dish_codes) > 1:
+            others = per_dish.copy()
+            others[rows, best] = -np.inf
+            second_sim = others.max(axis=1)
+        else:
+            second_sim = np.full(len(queries), -np.inf, dtype=np.float32)
+        return [
+            (dish_codes[label], float(sim), float(second) if np.isfinite(second) else None)
+            for label, sim, second in zip(best, best_sim, second_sim)
+        ]
+
+
+def open_oriented(image_path: str) -> Image.Image:
+    """
+    打开图片并按EXIF方向旋转
+    检测模型用OpenCV解码时会应用EXIF方向，检测框坐标基于旋转后的图片
+    """
+    with Image.open(image_path) as img:
+        return ImageOps.exif_transpose(img)
+
+
+def crop_detections(image: Image.Image, detections: List[Dict[str, Any]]) -> List[Image.Image]:
+    """按检测框裁剪图片"""
+    width, height = image.size
+    crops = []
+    for det in detections:
+        x1, y1, x2, y2 = det["bbox"]
+        box = (max(0, int(x1)), max(0, int(y1)), min(width, int(round(x2))), min(height, int(round(y2))))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            box = (0, 0, width, height)
+        crops.append(image.crop(box))
+    return crops
+
+
+class EmbeddingMatcher:
+    """
+    识别第二阶段：检测框裁剪图与参考向量匹配
+    每个模型（食堂）各自持有一个匹配器和一份参考向量，随模型一起加载和淘汰
+    """
+    def __init__(self, extractor, model_id: str = "default"):
+        self.extractor = extractor
+        self.model_id = model_id
+        self.batch_size = EMBEDDING_CONFIG["batch_size"]
+        self.threshold = EMBEDDING_CONFIG["similarity_threshold"]
+        self.min_margin = EMBEDDING_CONFIG["min_margin"]
+        self.index = EmbeddingIndex(
+            os.path.join(EMBEDDING_CONFIG["index_dir"], model_id),
+            extractor.name, getattr(extractor, "dim", None)
+        )
+
+    def embed(self, crops: List[Image.Image]) -> np.ndarray:
+        """分批提取特征"""
+        parts = [
+            self.extractor.extract(crops[i:i + self.batch_size])
+            for i in range(0, len(crops), self.batch_size)
+        ]
+        return np.concatenate(parts) if parts else np.zeros((0, self.index.dim or 0), dtype=np.float32)
+
+    def refine(self, image_paths: List[str], batch_results: List[List[Dict[str, Any]]]):
+        """
+        对一批图片的全部检测框统一提取特征并匹配，原地更新检测结果
+        只有在相似度达到阈值、高于检测置信度、且明显高于次相似菜品时才以向量匹配的菜品码为准，
+        否则只标注embedding_similarity，保留检测模型的菜品码
+        """
+        if len(self.index) == 0:
+            return
+        crops, targets = [], []
+        for image_path, detections in zip(image_paths, batch_results):
+            if not detections:
+                continue
+            crops.extend(crop_detections(open_oriented(image_path), detections))
+            targets.extend(detections)
+        if not crops:
+            return
+
+        matches = self.index.search(self.embed(crops))
+        for det, (dish_code, similarity, runner_up) in zip(targets, matches):
+            det["embedding_similarity"] = round(similarity, 3)
+            confident = (
+                dish_code is not None
+                and similarity >= self.threshold
+                and similarity > det.get("confidence", 0.0)
+                and (runner_up is None or similarity - runner_up >= self.min_margin)
+            )
+            if confident:
+                det["dish_code"] = dish_code
+                det["match_source"] = "embedding"
+            else:
+                det["match_source"] = "detector"
+
+    def add_reference(self, image_path: str, dish_code: str, bbox: Optional[List[float]] = None):
+        """将参考图片（或其中的一个区域）加入索引"""
+        img = open_oriented(image_path)
+        crop = crop_detections(img, [{"bbox": bbox}])[0] if bbox else img
+        self.index.add(self.embed([crop]), [dish_code], [image_path])
+
+    def add_references(self, items: List[Tuple[str, str]]):
+        """批量加入参考图片，items为(图片路径, 菜品码)"""
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            crops = [open_oriented(image_path) for image_path, _ in chunk]
+            self.index.add(self.extractor.extract(crops), [code for _, code in chunk],
+                           [image_path for image_path, _ in chunk])
+
+
+def create_matcher(model_id: str, model=None) -> Optional[EmbeddingMatcher]:
+    """按配置为模型创建向量匹配器，没有可用的特征提取器时返回None"""
+    extractor = create_extractor(model)
+    if extractor is None:
+        return None
+    return EmbeddingMatcher(extractor, model_id)
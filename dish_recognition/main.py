@@ -5,11 +5,13 @@
 """
 import os
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import cv2
 import numpy as np
@@ -22,22 +24,57 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from config import DEFAULT_DISHES, DATABASE_CONFIG
+from config import (DEFAULT_DISHES, DATABASE_CONFIG, SCHEDULER_CONFIG, DEDUP_CONFIG, EMBEDDING_CONFIG,
+                    MODEL_CONFIG, MODEL_REGISTRY_CONFIG, RENDER_CONFIG)
 from model_handler import get_model
+from model_registry import get_registry, ModelNotFound
 from data_manager import get_data_manager
+from upload_handler import save_upload, UploadRejected, UploadSizeLimitMiddleware
+from dish_stats import get_dish_stats
+from render_cache import get_render_cache, VARIANTS, FORMATS
+from phash_index import get_training_index, compute_dhash
+from scheduler import get_scheduler, deadline_from_header, DeadlineExceeded, QueueFull
 
 app = FastAPI(title="食堂菜品AI识别系统", description="基于YOLOv10n的菜品图像识别API")
 
+# 在表单解析之前限制上传请求体大小
+app.add_middleware(UploadSizeLimitMiddleware, paths=["/recognize/", "/add_training_data/"])
+
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
+# 推理调度器
+scheduler = get_scheduler()
+
+# 模型注册表
+registry = get_registry()
+
+# 菜品消费统计
+dish_stats = get_dish_stats()
+
+# 标注图渲染缓存
+render_cache = get_render_cache()
+
 # 初始化数据管理器
 data_manager = get_data_manager()
 DISH_DATABASE = data_manager.get_all_dishes()
 
 # 临时存储检测结果
 DETECTION_RESULTS = []
+# 按image_id索引检测结果，按最近访问顺序排列，超过上限时淘汰最久未访问的记录
+DETECTION_INDEX = OrderedDict()
+
+def remember_detection(record: Dict[str, Any]):
+    """保存检测记录，记录数超过上限时淘汰最旧的记录"""
+    max_records = RENDER_CONFIG["max_records"]
+    DETECTION_INDEX[record["image_id"]] = record
+    while len(DETECTION_INDEX) > max_records:
+        DETECTION_INDEX.popitem(last=False)
+    DETECTION_RESULTS.append(record)
+    # 历史列表按批截断，避免每次插入都移动整个列表
+    if len(DETECTION_RESULTS) > 2 * max_records:
+        del DETECTION_RESULTS[:-max_records]
 
 class DetectionResult(BaseModel):
     """检测结果模型"""
@@ -59,16 +96,40 @@ class AddTrainingDataRequest(BaseModel):
     dish_desc: str
     category: str
 
+@app.on_event("startup")
+async def preload_models():
+    """预加载配置的模型，避免首个请求等待加载"""
+    for model_id in MODEL_REGISTRY_CONFIG["preload"]:
+        try:
+            await run_in_threadpool(get_model, model_id)
+        except Exception as e:
+            print(f"预加载模型 {model_id} 失败: {str(e)}")
+
+@app.on_event("shutdown")
+async def save_stats_checkpoint():
+    """服务关闭时保存统计检查点"""
+    await run_in_threadpool(dish_stats.save_checkpoint)
+
 @app.get("/")
 async def root():
     return {"message": "欢迎使用食堂菜品AI识别系统!", "version": "1.0.0"}
 
 @app.post("/recognize/", response_model=RecognitionResponse)
-async def recognize_dish(image: UploadFile = File(...)):
+async def recognize_dish(request: Request, image: UploadFile = File(...),
+                         model_id: Optional[str] = Form(None)):
     """
     上传菜品图片进行识别
     返回菜品编码和描述
+    优先级由X-Priority请求头或X-API-Key确定，X-Deadline-Ms指定截止时间（毫秒）
+    model_id表单参数或X-Model-Id请求头指定使用的模型（食堂），未指定时使用默认模型
     """
+    model_id = model_id or request.headers.get(MODEL_REGISTRY_CONFIG["model_id_header"])
+    # 截止时间从收到请求时开始计算
+    deadline = deadline_from_header(request.headers.get(SCHEDULER_CONFIG["deadline_header"]))
+    priority = scheduler.resolve_priority(
+        request.headers.get(SCHEDULER_CONFIG["priority_header"]),
+        request.headers.get(SCHEDULER_CONFIG["api_key_header"])
+    )
     try:
         # 验证文件类型
         if not image.content_type.startswith("image/"):
@@ -77,17 +138,16 @@ async def recognize_dish(image: UploadFile = File(...)):
         # 生成唯一ID
         image_id = str(uuid.uuid4())
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{image_id}.jpg"
-        filepath = f"uploads/{filename}"
         
-        # 保存上传的图片
-        contents = await image.read()
-        with open(filepath, "wb") as f:
-            f.write(contents)
+        # 分块保存上传的图片，超限或格式不符时尽早拒绝
+        upload_info = await save_upload(image, "uploads", f"{timestamp}_{image_id}")
+        filepath = upload_info["filepath"]
         
-        # 使用YOLOv10n模型进行识别
-        model = get_model()
-        detection_results = model.predict(filepath)
+        # 按需加载所选模型（在线程池中进行，不阻塞事件循环），经调度器排队后进行识别
+        model = await run_in_threadpool(get_model, model_id)
+        detection_results = await scheduler.submit(
+            model.predict, filepath, priority=priority, deadline=deadline
+        )
         
         # 转换为API响应格式
         api_results = []
@@ -100,12 +160,19 @@ async def recognize_dish(image: UploadFile = File(...)):
             ))
         
         # 记录检测结果
-        DETECTION_RESULTS.append({
+        record = {
             "image_id": image_id,
             "filepath": filepath,
+            "model_id": model.model_id,
+            "model_version": model.version,
+            "sha256": upload_info["sha256"],
             "results": detection_results,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        remember_detection(record)
+        
+        # 增量更新菜品消费统计
+        dish_stats.record([det["dish_code"] for det in detection_results])
         
         return RecognitionResponse(
             success=True,
@@ -113,57 +180,106 @@ async def recognize_dish(image: UploadFile = File(...)):
             results=api_results,
             image_id=image_id
         )
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    except ModelNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"识别失败: {str(e)}")
 
 @app.post("/add_training_data/")
 async def add_training_data(
+    request: Request,
     image: UploadFile = File(...),
     dish_code: str = Form(...),
     dish_desc: str = Form(...),
-    category: str = Form(...)
+    category: str = Form(...),
+    model_id: Optional[str] = Form(None)
 ):
     """
     动态添加训练数据
     支持在线更新菜品数据集
+    model_id表单参数或X-Model-Id请求头指定参考图片加入哪个模型（食堂）的向量索引，未指定时使用默认模型
     """
+    model_id = model_id or request.headers.get(MODEL_REGISTRY_CONFIG["model_id_header"])
     try:
         # 验证菜品码格式
         if not dish_code or len(dish_code) < 5:
             raise HTTPException(status_code=400, detail="菜品码格式不正确")
         
-        # 保存训练图片
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"train_{timestamp}_{dish_code}.jpg"
-        filepath = f"data/training/{filename}"
-        
-        # 确保目录存在
-        os.makedirs("data/training", exist_ok=True)
-        
-        contents = await image.read()
-        with open(filepath, "wb") as f:
-            f.write(contents)
+        # 先加载目标模型，模型不存在时不保存图片
+        model = await run_in_threadpool(get_model, model_id) if EMBEDDING_CONFIG["enabled"] else None
         
-        # 使用数据管理器添加菜品
-        success = data_manager.add_dish(dish_code, dish_desc, category)
-        
-        if not success:
-            raise HTTPException(status_code=400, detail="菜品码已存在")
+        # 分块保存训练图片，超限或格式不符时尽早拒绝
+        # 文件名带唯一ID，同一秒内上传同一菜品的多张图片不会互相覆盖
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        upload_info = await save_upload(
+            image, "data/training", f"train_{timestamp}_{uuid.uuid4().hex}_{dish_code}"
+        )
+        filepath = upload_info["filepath"]
         
-        # 更新全局菜品数据库
-        global DISH_DATABASE
-        DISH_DATABASE = data_manager.get_all_dishes()
+        training_index = None
+        try:
+            # 感知哈希去重，查重和入索引在同一把锁内完成，近似重复的图片按配置跳过或标记
+            training_index = await run_in_threadpool(get_training_index)
+            image_hash = await run_in_threadpool(compute_dhash, filepath, training_index.hash_size)
+            added, duplicates = await run_in_threadpool(
+                training_index.check_and_add, filepath, image_hash, DEDUP_CONFIG["on_duplicate"] == "skip"
+            )
+            if not added:
+                names = ", ".join(d["filename"] for d in duplicates[:5])
+                raise HTTPException(status_code=409, detail=f"训练图片与已有图片近似重复，已跳过: {names}")
+            
+            # 菜品不存在时才新建，已有菜品直接补充训练图片和参考向量
+            new_dish = (not data_manager.get_dish_by_code(dish_code)
+                        and data_manager.add_dish(dish_code, dish_desc, category))
+            if new_dish:
+                # 更新全局菜品数据库
+                global DISH_DATABASE
+                DISH_DATABASE = data_manager.get_all_dishes()
+            
+            # 加入向量索引作为参考图片，无需重新训练即可识别新菜品
+            # 特征提取使用同一模型，经调度器以低优先级排队，不与识别请求并发或抢占
+            if model is not None and model.matcher is not None:
+                await scheduler.submit(
+                    model.matcher.add_reference, filepath, dish_code,
+                    priority=SCHEDULER_CONFIG["training_priority"]
+                )
+        except BaseException:
+            # 入库失败时删除图片并移出索引，避免残留图片影响之后的查重
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            if training_index is not None:
+                await run_in_threadpool(training_index.remove, os.path.basename(filepath))
+            raise
         
         return {
             "success": True,
             "message": "训练数据添加成功",
+            "new_dish": new_dish,
+            "model_id": model.model_id if model is not None else None,
             "dish_info": {
                 "dish_code": dish_code,
                 "dish_desc": dish_desc,
                 "category": category,
                 "image_path": filepath
-            }
+            },
+            "near_duplicates": duplicates
         }
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    except ModelNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"添加训练数据失败: {str(e)}")
 
@@ -186,13 +302,107 @@ async def detection_history():
         "history": DETECTION_RESULTS[-20:]  # 只返回最近20条记录
     }
 
+@app.get("/annotated/{image_id}")
+async def annotated_image(image_id: str, variant: str = "full", format: str = "jpeg"):
+    """
+    获取带检测框的标注图
+    variant: full 原尺寸标注图，thumb 缩略图；format: jpeg 或 webp
+    首次请求时在线程池中渲染并缓存，之后直接返回缓存文件
+    """
+    if variant not in VARIANTS:
+        raise HTTPException(status_code=400, detail=f"不支持的variant: {variant}")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {format}")
+    
+    record = DETECTION_INDEX.get(image_id)
+    if record is not None:
+        DETECTION_INDEX.move_to_end(image_id)
+        try:
+            f = await run_in_threadpool(render_cache.open_rendered, record, variant, format)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"渲染标注图失败: {str(e)}")
+    else:
+        # 服务重启后检测记录丢失，仍可返回已缓存的标注图
+        f = await run_in_threadpool(render_cache.open_cached, image_id, variant, format)
+        if f is None:
+            raise HTTPException(status_code=404, detail="未找到该图片的检测记录")
+    
+    # 从已打开的文件句柄读取，缓存淘汰删除文件不影响正在返回的响应
+    def iter_file():
+        try:
+            while True:
+                chunk = f.read(RENDER_CONFIG["stream_chunk_size"])
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+    
+    # 缓存键包含模型版本，同一URL的内容不会变化
+    return StreamingResponse(
+        iter_file(),
+        media_type="image/webp" if format == "webp" else "image/jpeg",
+        headers={
+            "Content-Length": str(os.fstat(f.fileno()).st_size),
+            "Cache-Control": f"public, max-age={RENDER_CONFIG['cache_max_age']}"
+        }
+    )
+
+@app.get("/annotated_cache/stats/")
+async def annotated_cache_stats():
+    """获取标注图缓存统计"""
+    return {
+        "success": True,
+        "stats": render_cache.get_stats()
+    }
+
+@app.get("/stats/")
+async def stats_summary():
+    """获取所有菜品的滚动时间窗口统计（按分钟、小时、天及餐次）"""
+    return {
+        "success": True,
+        "stats": dish_stats.get_summary()
+    }
+
+@app.get("/stats/{dish_code}")
+async def dish_stats_detail(dish_code: str, series: Optional[str] = None):
+    """
+    获取单个菜品的统计
+    series可选minute/hour/day或餐次名，返回该窗口的逐桶计数
+    """
+    result = dish_stats.get_dish_stats(dish_code, series)
+    if result is None:
+        raise HTTPException(status_code=404, detail="该菜品暂无统计数据")
+    return {
+        "success": True,
+        "stats": result
+    }
+
+@app.get("/scheduler/stats/")
+async def scheduler_stats():
+    """获取推理调度队列统计"""
+    return {
+        "success": True,
+        "stats": scheduler.get_stats()
+    }
+
+@app.get("/models/")
+async def list_models():
+    """获取模型注册表状态"""
+    return {
+        "success": True,
+        "registry": registry.get_stats()
+    }
+
 @app.get("/health/")
 async def health_check():
     """健康检查接口"""
     return {
         "status": "healthy",
         "service": "dish_recognition_api",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "backend": MODEL_CONFIG["backend"],
+        "loaded_models": [m["model_id"] for m in registry.get_stats()["loaded"]]
     }
 
 if __name__ == "__main__":
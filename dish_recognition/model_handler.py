@@ -5,26 +5,46 @@
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import zlib
 import cv2
 import numpy as np
 from typing import List, Tuple, Optional, Dict, Any
 from PIL import Image
 import torch
 from ultralytics import YOLO
-from config import MODEL_CONFIG, BASE_DIR
+from config import MODEL_CONFIG, BASE_DIR, EMBEDDING_CONFIG
+from synthetic_backend import SyntheticBackend
+from embedding_index import create_matcher
+from data_manager import get_data_manager
 
 class DishRecognitionModel:
-    def __init__(self):
+    def __init__(self, model_id: str = "default", model_path: Optional[str] = None,
+                 class_map: Optional[Dict[str, str]] = None):
         self.model = None
-        self.model_path = MODEL_CONFIG["model_path"]
+        self.model_id = model_id
+        self.model_path = model_path or MODEL_CONFIG["model_path"]
+        # 模型类别名到菜品码的映射，每个模型（食堂）各自维护
+        self.class_map = class_map or {}
         self.input_size = MODEL_CONFIG["input_size"]
         self.conf_threshold = MODEL_CONFIG["conf_threshold"]
         self.iou_threshold = MODEL_CONFIG["iou_threshold"]
         self.max_det = MODEL_CONFIG["max_det"]
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.backend = None
+        self._weights_bytes = None
         
-        # 初始化模型
-        self.load_model()
+        # 初始化模型，合成后端不加载权重
+        if MODEL_CONFIG["backend"] == "synthetic":
+            print(f"模型 {self.model_id} 使用合成推理后端")
+            self.backend = SyntheticBackend(self.dish_codes())
+        else:
+            self.load_model()
+        
+        # 向量匹配作为识别第二阶段，新菜品加入参考图片后即可识别；参考向量按模型分开保存
+        self.matcher = create_matcher(self.model_id, self.model) if EMBEDDING_CONFIG["enabled"] else None
+        
+        # 模型版本，用于区分不同权重产生的结果
+        self.version = self.compute_version()
     
     def load_model(self):
         """加载YOLOv10n模型"""
@@ -44,139 +64,131 @@ class DishRecognitionModel:
             self.model.to(self.device)
             
         except Exception as e:
-            print(f"模型加载失败: {str(e)}")
-            # 创建一个模拟模型用于演示
+            print(f"模型加载失败: {str(e)}，使用合成推理后端")
             self.model = None
+            self.backend = SyntheticBackend(self.dish_codes())
     
     def predict(self, image_path: str) -> List[Dict[str, Any]]:
         """
         对单张图片进行预测
         返回检测结果列表
         """
+        return self.predict_batch([image_path])[0]
+    
+    def predict_batch(self, image_paths: List[str]) -> List[List[Dict[str, Any]]]:
+        """
+        对多张图片进行批量预测
+        返回与输入顺序一致的检测结果列表
+        """
+        results = self.detect_batch(image_paths)
+        if self.matcher is not None:
+            try:
+                self.matcher.refine(image_paths, results)
+            except Exception as e:
+                print(f"向量匹配过程中出现错误: {str(e)}")
+            for detections in results:
+                for det in detections:
+                    if det.get("match_source") == "embedding":
+                        det["dish_desc"] = self.get_dish_description(det["dish_code"])
+        return results
+    
+    def detect_batch(self, image_paths: List[str]) -> List[List[Dict[str, Any]]]:
+        """识别第一阶段：检测模型输出菜品框和类别"""
         if self.model is None:
             # 模拟预测结果
-            return self.simulate_prediction(image_path)
+            return self.simulate_prediction_batch(image_paths)
         
         try:
             # 使用YOLO模型进行预测
+            # 向量提取复用同一个predictor，其embed参数会保留到之后的调用，这里显式清除
             results = self.model(
-                source=image_path,
+                source=list(image_paths),
                 conf=self.conf_threshold,
                 iou=self.iou_threshold,
                 max_det=self.max_det,
                 imgsz=self.input_size,
                 device=self.device,
+                embed=None,
                 verbose=False
             )
-            
-            detections = []
-            img = cv2.imread(image_path)
-            height, width = img.shape[:2]
-            
-            # 处理检测结果
-            for result in results:
-                boxes = result.boxes
-                if boxes is not None:
-                    for box in boxes:
-                        # 获取边界框坐标
-                        xyxy = box.xyxy[0].cpu().numpy()  # [x1, y1, x2, y2]
-                        
-                        # 获取置信度
-                        conf = float(box.conf[0])
-                        
-                        # 获取类别名称（这里需要映射到实际菜品名称）
-                        cls_id = int(box.cls[0])
-                        class_name = result.names[cls_id] if hasattr(result, 'names') else f"class_{cls_id}"
-                        
-                        # 将类别名映射到菜品码（模拟）
-                        dish_code = self.map_class_to_dish(class_name)
-                        dish_desc = self.get_dish_description(dish_code)
-                        
-                        detection = {
-                            "dish_code": dish_code,
-                            "dish_desc": dish_desc,
-                            "confidence": round(conf, 2),
-                            "bbox": [float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])],
-                            "bbox_normalized": [
-                                round(xyxy[0]/width, 3), 
-                                round(xyxy[1]/height, 3), 
-                                round(xyxy[2]/width, 3), 
-                                round(xyxy[3]/height, 3)
-                            ]
-                        }
-                        detections.append(detection)
-            
-            return detections
+            return [self.parse_result(result) for result in results]
             
         except Exception as e:
             print(f"预测过程中出现错误: {str(e)}")
             # 返回空结果
-            return []
+            return [[] for _ in image_paths]
     
-    def simulate_prediction(self, image_path: str) -> List[Dict[str, Any]]:
-        """
-        模拟预测结果（当真实模型不可用时）
-        """
-        print("使用模拟预测功能")
-        
-        # 加载图片获取尺寸
-        img = cv2.imread(image_path)
-        height, width = img.shape[:2]
-        
-        # 模拟检测到的菜品（随机选择）
-        from config import DEFAULT_DISHES
-        dish_codes = list(DEFAULT_DISHES.keys())
-        
-        detected_codes = []
-        num_detections = np.random.randint(1, 4)  # 随机检测1-3个菜品
+    def parse_result(self, result) -> List[Dict[str, Any]]:
+        """将单张图片的YOLO输出转换为检测结果列表"""
+        detections = []
+        # 原图尺寸由模型推理时读取，无需再次解码图片
+        height, width = result.orig_shape[:2]
         
-        results = []
-        for _ in range(num_detections):
-            # 随机选择一个菜品
-            dish_code = np.random.choice(dish_codes)
-            if dish_code not in detected_codes:  # 确保不重复
-                detected_codes.append(dish_code)
+        boxes = result.boxes
+        if boxes is not None:
+            for box in boxes:
+                # 获取边界框坐标
+                xyxy = box.xyxy[0].cpu().numpy()  # [x1, y1, x2, y2]
                 
-                # 随机生成边界框坐标
-                x_center = np.random.uniform(0.2, 0.8) * width
-                y_center = np.random.uniform(0.2, 0.8) * height
-                w = np.random.uniform(0.1, 0.4) * width
-                h = np.random.uniform(0.1, 0.4) * height
+                # 获取置信度
+                conf = float(box.conf[0])
                 
-                x1 = max(0, x_center - w/2)
-                y1 = max(0, y_center - h/2)
-                x2 = min(width, x_center + w/2)
-                y2 = min(height, y_center + h/2)
+                # 获取类别名称（这里需要映射到实际菜品名称）
+                cls_id = int(box.cls[0])
+                class_name = result.names[cls_id] if hasattr(result, 'names') else f"class_{cls_id}"
                 
-                # 随机置信度
-                confidence = round(np.random.uniform(0.7, 0.99), 2)
+                # 将类别名映射到菜品码（模拟）
+                dish_code = self.map_class_to_dish(class_name)
+                dish_desc = self.get_dish_description(dish_code)
                 
-                results.append({
+                detection = {
                     "dish_code": dish_code,
-                    "dish_desc": DEFAULT_DISHES[dish_code]["dish_desc"],
-                    "confidence": confidence,
-                    "bbox": [float(x1), float(y1), float(x2), float(y2)],
+                    "dish_desc": dish_desc,
+                    "confidence": round(conf, 2),
+                    "bbox": [float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])],
                     "bbox_normalized": [
-                        round(x1/width, 3), 
-                        round(y1/height, 3), 
-                        round(x2/width, 3), 
-                        round(y2/height, 3)
+                        round(xyxy[0]/width, 3), 
+                        round(xyxy[1]/height, 3), 
+                        round(xyxy[2]/width, 3), 
+                        round(xyxy[3]/height, 3)
                     ]
-                })
+                }
+                detections.append(detection)
         
-        return results
+        return detections
+    
+    def simulate_prediction(self, image_path: str) -> List[Dict[str, Any]]:
+        """
+        模拟预测结果（当真实模型不可用时）
+        相同图片内容始终返回相同结果
+        """
+        return self.backend.predict(image_path)
+    
+    def simulate_prediction_batch(self, image_paths: List[str]) -> List[List[Dict[str, Any]]]:
+        """批量模拟预测结果"""
+        return self.backend.predict_batch(image_paths)
+    
+    def dish_codes(self) -> List[str]:
+        """该模型可能输出的菜品码"""
+        if self.class_map:
+            return sorted(set(self.class_map.values()))
+        from config import DEFAULT_DISHES
+        return list(DEFAULT_DISHES.keys())
     
     def map_class_to_dish(self, class_name: str) -> str:
         """
         将模型输出的类别映射到菜品码
-        在实际应用中，这应该是训练时定义的映射关系
+        优先使用该模型训练时定义的映射关系
         """
-        # 模拟映射逻辑
+        if class_name in self.class_map:
+            return self.class_map[class_name]
+        
+        # 未定义映射时的模拟映射逻辑
         from config import DEFAULT_DISHES
         dish_codes = list(DEFAULT_DISHES.keys())
         
-        # 简单的哈希映射，确保一致性
-        hash_val = hash(class_name) % len(dish_codes)
+        # 简单的哈希映射，使用crc32保证跨进程一致
+        hash_val = zlib.crc32(class_name.encode("utf-8")) % len(dish_codes)
         return dish_codes[hash_val]
     
     def get_dish_description(self, dish_code: str) -> str:
@@ -184,7 +196,36 @@ class DishRecognitionModel:
         根据菜品码获取菜品描述
         """
         from config import DEFAULT_DISHES
-        return DEFAULT_DISHES.get(dish_code, {}).get("dish_desc", dish_code)
+        dish = get_data_manager().get_dish_by_code(dish_code) or DEFAULT_DISHES.get(dish_code, {})
+        return dish.get("dish_desc", dish_code)
+    
+    def compute_version(self) -> str:
+        """模型版本：模型ID加权重文件修改时间，合成后端为synthetic"""
+        if self.model is None:
+            return f"{self.model_id}-synthetic"
+        if os.path.exists(self.model_path):
+            return f"{self.model_id}-{int(os.path.getmtime(self.model_path))}"
+        return f"{self.model_id}-pretrained"
+    
+    def memory_footprint(self) -> int:
+        """
+        估算模型占用的内存（字节，含内存中新增的参考向量），用于模型注册表的内存预算
+        权重大小只计算一次，参考向量随添加而增长，每次调用时重新计入
+        """
+        footprint = self.matcher.index.memory_bytes() if self.matcher is not None else 0
+        if self._weights_bytes is None:
+            self._weights_bytes = self.weights_footprint()
+        return footprint + self._weights_bytes
+    
+    def weights_footprint(self) -> int:
+        """估算模型权重占用的内存（字节）"""
+        if self.model is None:
+            return 0
+        try:
+            module = self.model.model
+            return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+        except Exception:
+            return os.path.getsize(self.model_path) if os.path.exists(self.model_path) else 0
     
     def train_model(self, data_path: str, epochs: int = 100):
         """
@@ -219,9 +260,10 @@ class DishRecognitionModel:
             print(f"训练过程中出现错误: {str(e)}")
             return False
 
-# 全局模型实例
-dish_model = DishRecognitionModel()
-
-def get_model():
-    """获取模型实例"""
-    return dish_model
\ No newline at end of file
+def get_model(model_id: Optional[str] = None):
+    """
+    获取模型实例
+    按model_id从模型注册表中获取，未指定时返回默认模型，未加载的模型按需加载
+    """
+    from model_registry import get_registry
+    return get_registry().get(model_id)
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""
+模型注册表
+按站点/模型ID管理多个模型，按需加载，超出内存预算时按LRU淘汰
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Any, Optional
+from config import MODEL_REGISTRY_CONFIG, MODELS_DIR
+
+MODEL_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ModelNotFound(Exception):
+    """请求的模型不存在"""
+    pass
+
+
+class ModelRegistry:
+    """
+    多模型注册表
+    同一模型的并发首次请求共享一次加载；已加载模型按最近使用顺序排列，
+    总内存超过预算时从最久未使用的模型开始淘汰（至少保留一个）
+    模型加载后内存占用仍会增长（新增参考向量），每次检查预算时重新计算
+    """
+    def __init__(self):
+        self.default_model_id = MODEL_REGISTRY_CONFIG["default_model_id"]
+        self.memory_budget = MODEL_REGISTRY_CONFIG["memory_budget_mb"] * 1024 * 1024
+        self.models = OrderedDict()   # model_id -> (模型实例, 内存占用字节数)
+        self.loading = {}             # model_id -> Future
+        self.lock = threading.Lock()
+        self.stats = {"loads": 0, "hits": 0, "evictions": 0, "load_failures": 0}
+
+    def resolve_spec(self, model_id: str) -> Dict[str, Any]:
+        """
+        查找模型配置
+        优先使用MODEL_REGISTRY_CONFIG中注册的模型，
+        其次按 models/<model_id>/weights.pt 和 class_map.json 约定查找
+        """
+        configured = MODEL_REGISTRY_CONFIG["models"].get(model_id)
+        if configured is not None:
+            return dict(configured)
+
+        if not MODEL_ID_PATTERN.match(model_id):
+            raise ModelNotFound(f"模型ID格式不正确: {model_id}")
+        model_dir = os.path.join(MODELS_DIR, model_id)
+        weights_path = os.path.join(model_dir, "weights.pt")
+        if not os.path.exists(weights_path):
+            raise ModelNotFound(f"模型不存在: {model_id}")
+
+        class_map = {}
+        class_map_path = os.path.join(model_dir, "class_map.json")
+        if os.path.exists(class_map_path):
+            with open(class_map_path, 'r', encoding='utf-8') as f:
+                class_map = json.load(f)
+        return {"model_path": weights_path, "class_map": class_map}
+
+    def get(self, model_id: Optional[str] = None):
+        """获取模型实例，未加载时加载；并发请求同一模型时只加载一次"""
+        model_id = model_id or self.default_model_id
+        with self.lock:
+            if model_id in self.models:
+                self.models.move_to_end(model_id)
+                self.stats["hits"] += 1
+                model = self.models[model_id][0]
+                self._evict_over_budget()
+                return model
+            future = self.loading.get(model_id)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.loading[model_id] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            model, footprint = self._load(model_id)
+        except BaseException as e:
+            with self.lock:
+                self.stats["load_failures"] += 1
+                del self.loading[model_id]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.models[model_id] = (model, footprint)
+            del self.loading[model_id]
+            self.stats["loads"] += 1
+            self._evict_over_budget()
+        future.set_result(model)
+        return model
+
+    def _load(self, model_id: str):
+        from model_handler import DishRecognitionModel
+        spec = self.resolve_spec(model_id)
+        start = time.time()
+        model = DishRecognitionModel(
+            model_id=model_id,
+            model_path=spec.get("model_path"),
+            class_map=spec.get("class_map")
+        )
+        footprint = model.memory_footprint()
+        print(f"模型 {model_id} 加载完成，耗时 {time.time() - start:.2f}s，"
+              f"占用约 {footprint / 1024 / 1024:.1f}MB")
+        return model, footprint
+
+    def _evict_over_budget(self):
+        """按LRU顺序淘汰模型，直到总内存不超过预算（需持有锁）"""
+        self._refresh_footprints()
+        total = sum(footprint for _, footprint in self.models.values())
+        while total > self.memory_budget and len(self.models) > 1:
+            model_id, (_, footprint) = self.models.popitem(last=False)
+            total -= footprint
+            self.stats["evictions"] += 1
+            print(f"内存超出预算，淘汰模型 {model_id}")
+
+    def _refresh_footprints(self):
+        """重新计算已加载模型的内存占用（需持有锁）"""
+        for model_id, (model, _) in list(self.models.items()):
+            self.models[model_id] = (model, model.memory_footprint())
+
+    def evict(self, model_id: str) -> bool:
+        """手动卸载模型"""
+        with self.lock:
+            return self.models.pop(model_id, None) is not None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取注册表状态"""
+        with self.lock:
+            self._refresh_footprints()
+            loaded = [
+                {"model_id": model_id, "memory_mb": round(footprint / 1024 / 1024, 1)}
+                for model_id, (_, footprint) in self.models.items()
+            ]
+            return {
+                "default_model_id": self.default_model_id,
+                "memory_budget_mb": MODEL_REGISTRY_CONFIG["memory_budget_mb"],
+                "memory_used_mb": round(sum(m["memory_mb"] for m in loaded), 1),
+                "loaded": loaded,  # 按最近使用顺序，末尾为最近使用
+                "loading": list(self.loading),
+                **self.stats
+            }
+
+
+# 全局注册表实例
+registry = ModelRegistry()
+
+def get_registry():
+    """获取模型注册表实例"""
+    return registry
@@ -0,0 +1,241 @@
+"""
+感知哈希索引
+为训练图片计算dHash，并用BK树按汉明距离快速查找近似重复图片
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import json
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+from config import DATABASE_CONFIG, DEDUP_CONFIG, UPLOAD_CONFIG
+
+
+def compute_dhash(image_path: str, hash_size: int = 8) -> int:
+    """
+    计算图片的差值哈希（dHash）
+    缩放为(hash_size+1)xhash_size灰度图，比较相邻像素得到hash_size*hash_size位整数
+    """
+    with Image.open(image_path) as img:
+        # JPEG按缩小尺寸解码，避免完整解码大图
+        img.draft("L", (hash_size * 4, hash_size * 4))
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """两个哈希值的汉明距离"""
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    BK树
+    按汉明距离组织哈希值，查询半径r内的元素时只需访问距离在[d-r, d+r]内的子树
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value: int, item: str):
+        """插入一个哈希值及其关联的条目"""
+        self.size += 1
+        if self.root is None:
+            self.root = (hash_value, [item], {})
+            return
+        node = self.root
+        while True:
+            node_hash, items, children = node
+            distance = hamming_distance(hash_value, node_hash)
+            if distance == 0:
+                items.append(item)
+                return
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (hash_value, [item], {})
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, str]]:
+        """查找距离不超过max_distance的所有条目，按距离升序返回(距离, 条目)"""
+        if self.root is None:
+            return []
+        matches = []
+        stack = [self.root]
+        while stack:
+            node_hash, items, children = stack.pop()
+            distance = hamming_distance(hash_value, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in items)
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in children.items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+        matches.sort()
+        return matches
+
+
+class TrainingImageIndex:
+    """
+    训练图片的感知哈希索引
+    哈希值缓存在JSON文件中，按文件大小和修改时间判断是否需要重新计算
+    """
+    def __init__(self, training_dir: str = None):
+        self.training_dir = training_dir or DATABASE_CONFIG["training_data_path"]
+        self.index_path = DEDUP_CONFIG["index_path"]
+        self.hash_size = DEDUP_CONFIG["hash_size"]
+        self.max_distance = DEDUP_CONFIG["max_distance"]
+        self.entries = {}
+        self.removed = set()
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+        self.load_index()
+
+    def load_index(self):
+        """加载哈希缓存并与训练目录同步"""
+        cached = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+            except Exception as e:
+                print(f"加载感知哈希索引失败: {str(e)}，重新计算")
+
+        entries = {}
+        for filename in self.list_images():
+            path = os.path.join(self.training_dir, filename)
+            stat = os.stat(path)
+            entry = cached.get(filename)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                entries[filename] = entry
+                continue
+            try:
+                hash_value = compute_dhash(path, self.hash_size)
+            except Exception as e:
+                print(f"计算感知哈希失败 {filename}: {str(e)}")
+                continue
+            entries[filename] = {"hash": f"{hash_value:x}", "size": stat.st_size, "mtime": stat.st_mtime}
+
+        with self.lock:
+            self.entries = entries
+            self.rebuild_tree()
+        if entries != cached:
+            self.save_index()
+        print(f"感知哈希索引已加载，共 {len(entries)} 张训练图片")
+
+    def list_images(self) -> List[str]:
+        """列出训练目录中的图片文件"""
+        if not os.path.isdir(self.training_dir):
+            return []
+        allowed = UPLOAD_CONFIG["allowed_extensions"]
+        return sorted(
+            name for name in os.listdir(self.training_dir)
+            if os.path.splitext(name)[1].lower() in allowed
+        )
+
+    def rebuild_tree(self):
+        """根据当前条目重建BK树"""
+        self.tree = BKTree()
+        self.removed = set()
+        for filename, entry in self.entries.items():
+            self.tree.add(int(entry["hash"], 16), filename)
+
+    def save_index(self):
+        """保存哈希缓存"""
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with self.lock:
+                data = dict(self.entries)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            print(f"保存感知哈希索引失败: {str(e)}")
+
+    def find_duplicates(self, hash_value: int, max_distance: Optional[int] = None) -> List[Dict[str, Any]]:
+        """查找与给定哈希近似重复的训练图片"""
+        with self.lock:
+            return self._find_duplicates(hash_value, max_distance)
+
+    def _find_duplicates(self, hash_value: int, max_distance: Optional[int] = None) -> List[Dict[str, Any]]:
+        """查找近似重复图片（需持有锁）"""
+        if max_distance is None:
+            max_distance = self.max_distance
+        matches = self.tree.search(hash_value, max_distance)
+        results = []
+        seen = set()
+        for distance, filename in matches:
+            # 跳过已移除或已被覆盖（哈希值变化）的旧节点
+            entry = self.entries.get(filename)
+            if filename in seen or filename in self.removed or entry is None:
+                continue
+            if hamming_distance(int(entry["hash"], 16), hash_value) != distance:
+                continue
+            seen.add(filename)
+            results.append({"filename": filename, "distance": distance})
+        return results
+
+    def check_and_add(self, filepath: str, hash_value: int, skip_duplicates: bool) -> Tuple[bool, List[Dict[str, Any]]]:
+        """
+        在同一把锁内查重并加入索引，避免并发上传的近似重复图片同时通过检查
+        skip_duplicates为True且存在近似重复时不加入索引
+        返回(是否已加入, 近似重复列表)
+        """
+        filename = os.path.basename(filepath)
+        stat = os.stat(filepath)
+        with self.lock:
+            duplicates = self._find_duplicates(hash_value)
+            if duplicates and skip_duplicates:
+                return False, duplicates
+            self._add_locked(filename, hash_value, stat)
+        self.save_index()
+        return True, duplicates
+
+    def _add_locked(self, filename: str, hash_value: int, stat):
+        self.entries[filename] = {"hash": f"{hash_value:x}", "size": stat.st_size, "mtime": stat.st_mtime}
+        self.removed.discard(filename)
+        self.tree.add(hash_value, filename)
+
+    def add(self, filepath: str, hash_value: Optional[int] = None):
+        """将新保存的训练图片加入索引"""
+        if hash_value is None:
+            hash_value = compute_dhash(filepath, self.hash_size)
+        filename = os.path.basename(filepath)
+        stat = os.stat(filepath)
+        with self.lock:
+            self._add_locked(filename, hash_value, stat)
+        self.save_index()
+
+    def remove(self, filename: str):
+        """从索引中移除图片（BK树中仅做标记，重建时清理）"""
+        with self.lock:
+            self.entries.pop(filename, None)
+            self.removed.add(filename)
+        self.save_index()
+
+    def hash_of(self, filename: str) -> Optional[int]:
+        """获取已索引图片的哈希值"""
+        entry = self.entries.get(filename)
+        return int(entry["hash"], 16) if entry else None
+
+
+# 全局索引实例（首次使用时加载）
+_training_index = None
+_training_index_lock = threading.Lock()
+
+def get_training_index():
+    """获取训练图片感知哈希索引实例"""
+    global _training_index
+    if _training_index is None:
+        with _training_index_lock:
+            if _training_index is None:
+                _training_index = TrainingImageIndex()
+    return _training_index
@@ -0,0 +1,214 @@
+"""
+标注图渲染缓存
+按需渲染带检测框的标注图和缩略图，按image_id和模型版本缓存在磁盘上，
+缓存总大小超过上限时按LRU淘汰
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Any, List, Optional, BinaryIO
+from PIL import Image, ImageDraw, ImageOps
+from config import RENDER_CONFIG
+
+# 渲染变体：full 原尺寸标注图，thumb 缩略图
+VARIANTS = ("full", "thumb")
+FORMATS = {"jpeg": ".jpg", "webp": ".webp"}
+SAFE_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+EXIF_ORIENTATION = 0x0112
+
+# 检测框颜色，按菜品码循环取色
+BOX_COLORS = [
+    (230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48),
+    (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 190),
+]
+
+
+def render_annotated(src_path: str, detections: List[Dict[str, Any]], out_path: str,
+                     variant: str, image_format: str):
+    """绘制检测框并保存为指定格式"""
+    with Image.open(src_path) as img:
+        # 检测模型用OpenCV解码时会应用EXIF方向，检测框坐标基于旋转后的图片
+        orig_width, orig_height = img.size
+        if img.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            orig_width, orig_height = orig_height, orig_width
+        if variant == "thumb":
+            max_side = RENDER_CONFIG["thumbnail_size"]
+            # JPEG按缩小尺寸解码，避免完整解码原图
+            img.draft("RGB", (max_side, max_side))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            img.thumbnail((max_side, max_side))
+        else:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+
+    # 检测框坐标按原图尺寸，缩放后按比例换算
+    width, height = img.size
+    ratio_x, ratio_y = width / orig_width, height / orig_height
+    draw = ImageDraw.Draw(img)
+    line_width = max(1, round(max(width, height) / 300))
+    for det in detections:
+        x1, y1, x2, y2 = det["bbox"]
+        box = [x1 * ratio_x, y1 * ratio_y, x2 * ratio_x, y2 * ratio_y]
+        color = BOX_COLORS[sum(det["dish_code"].encode("utf-8")) % len(BOX_COLORS)]
+        draw.rectangle(box, outline=color, width=line_width)
+        if variant == "full":
+            # 默认字体不支持中文，标签使用菜品码和置信度
+            label = f"{det['dish_code']} {det.get('confidence', 0):.2f}"
+            text_box = draw.textbbox((box[0], box[1]), label)
+            text_y = max(0, box[1] - (text_box[3] - text_box[1]) - 2)
+            draw.rectangle([box[0], text_y, box[0] + text_box[2] - text_box[0] + 4,
+                            text_y + text_box[3] - text_box[1] + 2], fill=color)
+            draw.text((box[0] + 2, text_y), label, fill=(255, 255, 255))
+
+    tmp_path = out_path + ".tmp"
+    if image_format == "webp":
+        img.save(tmp_path, "WEBP", quality=RENDER_CONFIG["webp_quality"])
+    else:
+        img.save(tmp_path, "JPEG", quality=RENDER_CONFIG["jpeg_quality"], optimize=True)
+    os.replace(tmp_path, out_path)
+
+
+class RenderCache:
+    """
+    标注图磁盘缓存
+    文件名为 {image_id}__{模型版本}__{变体}.{扩展名}；同一文件的并发请求只渲染一次
+    """
+    def __init__(self):
+        self.cache_dir = RENDER_CONFIG["cache_dir"]
+        self.max_bytes = RENDER_CONFIG["max_cache_mb"] * 1024 * 1024
+        self.entries = OrderedDict()   # 文件名 -> 大小，按最近访问顺序
+        self.total_bytes = 0
+        self.rendering = {}            # 文件名 -> Future
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "renders": 0, "evictions": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        """启动时按访问时间加载已有缓存文件"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def cache_name(image_id: str, model_version: str, variant: str, image_format: str) -> str:
+        return SAFE_NAME.sub("_", f"{image_id}__{model_version}__{variant}") + FORMATS[image_format]
+
+    def open_cached(self, image_id: str, variant: str, image_format: str) -> Optional[BinaryIO]:
+        """
+        不知道模型版本时（如服务重启后）查找并打开该图片已有的缓存
+        在锁内打开文件，返回的文件句柄不受之后的淘汰影响
+        """
+        prefix = SAFE_NAME.sub("_", image_id) + "__"
+        suffix = SAFE_NAME.sub("_", f"__{variant}") + FORMATS[image_format]
+        with self.lock:
+            for name in reversed(list(self.entries)):
+                if name.startswith(prefix) and name.endswith(suffix):
+                    f = self._open_entry(name)
+                    if f is not None:
+                        self.stats["hits"] += 1
+                        return f
+        return None
+
+    def open_rendered(self, record: Dict[str, Any], variant: str, image_format: str) -> BinaryIO:
+        """
+        返回已打开的标注图文件，未缓存时渲染（阻塞调用，应在线程池中执行）
+        文件在锁内打开，返回后即使被淘汰也能完整读取；缓存文件丢失时重新渲染
+        """
+        name = self.cache_name(record["image_id"], record.get("model_version", "unknown"), variant, image_format)
+        path = os.path.join(self.cache_dir, name)
+        while True:
+            with self.lock:
+                f = self._open_entry(name)
+                if f is not None:
+                    self.stats["hits"] += 1
+                    return f
+                future = self.rendering.get(name)
+                owner = future is None
+                if owner:
+                    future = Future()
+                    self.rendering[name] = future
+            if owner:
+                break
+            # 等待其他请求渲染完成后重新在锁内打开
+            future.result()
+
+        try:
+            render_annotated(record["filepath"], record["results"], path, variant, image_format)
+            size = os.path.getsize(path)
+        except BaseException as e:
+            with self.lock:
+                del self.rendering[name]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.rendering[name]
+            # 重新渲染时先扣除旧文件的大小
+            self.total_bytes -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_bytes += size
+            self.stats["renders"] += 1
+            try:
+                f = open(path, "rb")
+            finally:
+                self._evict(keep=name)
+        future.set_result(None)
+        return f
+
+    def _open_entry(self, name: str) -> Optional[BinaryIO]:
+        """打开缓存文件并标记为最近使用，文件已丢失时移除该条目（需持有锁）"""
+        if name not in self.entries:
+            return None
+        try:
+            f = open(os.path.join(self.cache_dir, name), "rb")
+        except FileNotFoundError:
+            self.total_bytes -= self.entries.pop(name)
+            return None
+        self.entries.move_to_end(name)
+        return f
+
+    def _evict(self, keep: Optional[str] = None):
+        """按LRU淘汰缓存文件直到总大小不超过上限（需持有锁）"""
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = next(iter(self.entries.items()))
+            if name == keep:
+                break
+            del self.entries[name]
+            self.total_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计"""
+        with self.lock:
+            return {
+                "files": len(self.entries),
+                "size_mb": round(self.total_bytes / 1024 / 1024, 2),
+                "max_size_mb": RENDER_CONFIG["max_cache_mb"],
+                **self.stats
+            }
+
+
+# 全局缓存实例
+render_cache = RenderCache()
+
+def get_render_cache():
+    """获取标注图缓存实例"""
+    return render_cache
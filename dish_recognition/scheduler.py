@@ -0,0 +1,232 @@
+"""
+推理调度器
+在模型前按优先级排队执行推理请求，支持请求截止时间
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from config import SCHEDULER_CONFIG
+
+
+class DeadlineExceeded(Exception):
+    """请求在开始执行前已超过截止时间"""
+    pass
+
+
+class QueueFull(Exception):
+    """调度队列已满"""
+    pass
+
+
+class _PriorityStats:
+    """单个优先级的队列统计"""
+    def __init__(self):
+        self.queued = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.late = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        started = self.completed + self.failed
+        return {
+            "queued": self.queued,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "late": self.late,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "avg_run_ms": round(self.total_run / started * 1000, 2) if started else 0.0,
+        }
+
+
+class InferenceScheduler:
+    """
+    优先级推理调度器
+    高优先级请求先执行；已过截止时间的请求直接丢弃，不再计算
+    推理在线程池中执行，不阻塞事件循环
+    """
+    def __init__(self):
+        self.priorities = SCHEDULER_CONFIG["priorities"]
+        self.default_priority = SCHEDULER_CONFIG["default_priority"]
+        self.max_queue_size = SCHEDULER_CONFIG["max_queue_size"]
+        self.num_workers = SCHEDULER_CONFIG["workers"]
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix="inference")
+        self.stats = {name: _PriorityStats() for name in self.priorities}
+        self._queue = []
+        self._live = 0        # 队列中仍在等待执行的任务数（不含已超时或取消的）
+        self._dropped = 0     # 队列中已超时或取消、尚未被取出的任务数
+        self._counter = itertools.count()
+        self._loop = None
+        self._not_empty = None
+        self._workers = []
+
+    def _ensure_started(self):
+        """首次提交时在当前事件循环中启动工作协程"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = []
+        self._live = 0
+        self._dropped = 0
+        self._not_empty = asyncio.Condition()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    def resolve_priority(self, priority: Optional[str] = None, api_key: Optional[str] = None) -> str:
+        """根据请求头中的优先级或API Key确定优先级"""
+        if api_key:
+            mapped = SCHEDULER_CONFIG["api_key_priorities"].get(api_key)
+            if mapped in self.priorities:
+                return mapped
+        if priority:
+            priority = priority.strip().lower()
+            if priority in self.priorities:
+                return priority
+        return self.default_priority
+
+    async def submit(self, func: Callable, *args, priority: Optional[str] = None,
+                     deadline: Optional[float] = None) -> Any:
+        """
+        提交推理任务并等待结果
+        deadline为time.monotonic()时间戳，超过后任务不再执行并抛出DeadlineExceeded
+        """
+        self._ensure_started()
+        priority = priority if priority in self.priorities else self.default_priority
+        stats = self.stats[priority]
+        stats.submitted += 1
+
+        if self._live >= self.max_queue_size:
+            stats.rejected += 1
+            raise QueueFull("推理队列已满，请稍后重试")
+
+        future = self._loop.create_future()
+        # 任务状态：queued 排队中，started 已开始执行，dropped 排队中超时或取消
+        state = ["queued"]
+        entry = (self.priorities[priority], next(self._counter), priority,
+                 time.monotonic(), deadline, func, args, future, state)
+        async with self._not_empty:
+            heapq.heappush(self._queue, entry)
+            self._live += 1
+            stats.queued += 1
+            self._not_empty.notify()
+
+        try:
+            if deadline is None:
+                return await future
+            # 超过截止时间后立即返回，队列中的任务被取消，不再计算
+            return await asyncio.wait_for(future, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            # 排队中超时的任务不会再执行，计为expired；
+            # 执行中超时的任务由工作协程计入completed/failed，这里只记为late
+            if state[0] == "started":
+                stats.late += 1
+            else:
+                stats.expired += 1
+                self._drop(state, stats)
+            raise DeadlineExceeded("请求已超过截止时间")
+        except asyncio.CancelledError:
+            self._drop(state, stats)
+            raise
+
+    def _drop(self, state, stats: _PriorityStats):
+        """
+        将排队中的任务标记为已放弃，立即从排队计数中扣除
+        堆中的条目由工作协程取出时跳过；放弃的条目过多时重建堆
+        """
+        if state[0] != "queued":
+            return
+        state[0] = "dropped"
+        stats.queued -= 1
+        self._live -= 1
+        self._dropped += 1
+        if self._dropped > self.max_queue_size:
+            self._queue = [entry for entry in self._queue if entry[-1][0] != "dropped"]
+            heapq.heapify(self._queue)
+            self._dropped = 0
+
+    async def _worker(self):
+        while True:
+            async with self._not_empty:
+                while not self._queue:
+                    await self._not_empty.wait()
+                _, _, priority, enqueued_at, deadline, func, args, future, state = heapq.heappop(self._queue)
+
+            if state[0] == "dropped":
+                self._dropped -= 1
+                continue
+            stats = self.stats[priority]
+            stats.queued -= 1
+            self._live -= 1
+            if future.cancelled():
+                continue
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                stats.expired += 1
+                future.set_exception(DeadlineExceeded("请求已超过截止时间"))
+                continue
+
+            state[0] = "started"
+            wait = now - enqueued_at
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            try:
+                result = await self._loop.run_in_executor(self.executor, func, *args)
+            except Exception as e:
+                stats.failed += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                stats.completed += 1
+                if not future.cancelled():
+                    future.set_result(result)
+            stats.total_run += time.monotonic() - now
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各优先级队列统计"""
+        return {
+            "workers": self.num_workers,
+            "queue_length": self._live,
+            "max_queue_size": self.max_queue_size,
+            "priorities": {name: self.stats[name].to_dict() for name in self.priorities},
+        }
+
+
+def deadline_from_header(value: Optional[str]) -> Optional[float]:
+    """
+    将请求头中的相对截止时间（毫秒）转换为time.monotonic()时间戳
+    无法解析、非有限值或负数时视为未指定
+    """
+    if value is None or value == "":
+        return None
+    try:
+        budget_ms = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(budget_ms) or budget_ms < 0:
+        return None
+    return time.monotonic() + budget_ms / 1000.0
+
+
+# 全局调度器实例
+scheduler = InferenceScheduler()
+
+def get_scheduler():
+    """获取调度器实例"""
+    return scheduler
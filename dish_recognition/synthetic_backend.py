@@ -0,0 +1,128 @@
+"""
+合成推理后端
+不依赖模型权重和网络，用于容量测试和CI压测
+相同图片（按内容哈希）始终返回相同的检测结果，耗时按配置的分布模拟
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import hashlib
+import threading
+import time
+from typing import List, Dict, Any, Tuple
+import numpy as np
+from config import SYNTHETIC_BACKEND_CONFIG, DEFAULT_DISHES
+from upload_handler import probe_image_file
+
+
+def file_sha256(image_path: str, chunk_size: int = 64 * 1024) -> str:
+    """分块计算文件内容的SHA-256"""
+    hasher = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class SyntheticBackend:
+    def __init__(self, dish_codes: List[str] = None):
+        self.config = SYNTHETIC_BACKEND_CONFIG
+        self.dish_codes = sorted(dish_codes or DEFAULT_DISHES.keys())
+        # 耗时采样使用独立的随机源，保证压测可复现
+        self._timing_rng = np.random.default_rng(self.config["seed"])
+        self._timing_lock = threading.Lock()
+        self._burn_a = np.random.default_rng(0).random((64, 64))
+
+    def predict(self, image_path: str) -> List[Dict[str, Any]]:
+        """对单张图片生成确定性的检测结果"""
+        return self.predict_batch([image_path])[0]
+
+    def predict_batch(self, image_paths: List[str]) -> List[List[Dict[str, Any]]]:
+        """
+        批量生成检测结果
+        批次耗时 = 批次固定开销 + 首张图片耗时 + 其余图片耗时 * batch_efficiency
+        """
+        if not image_paths:
+            return []
+        start = time.perf_counter()
+        results = [self._detect(path) for path in image_paths]
+        self._simulate_latency(len(image_paths), time.perf_counter() - start)
+        return results
+
+    def _detect(self, image_path: str) -> List[Dict[str, Any]]:
+        digest = file_sha256(image_path)
+        width, height = self._image_size(image_path)
+        rng = np.random.default_rng([int(digest[:16], 16), self.config["seed"]])
+
+        det_cfg = self.config["detections"]
+        num_detections = int(rng.integers(det_cfg["min"], det_cfg["max"] + 1))
+        num_detections = min(num_detections, len(self.dish_codes))
+        chosen = rng.choice(len(self.dish_codes), size=num_detections, replace=False)
+        conf_low, conf_high = self.config["confidence"]
+
+        results = []
+        for idx in chosen:
+            dish_code = self.dish_codes[int(idx)]
+            x_center, y_center = (float(v) for v in rng.uniform(0.2, 0.8, size=2))
+            w, h = (float(v) for v in rng.uniform(0.1, 0.4, size=2))
+
+            x1 = max(0.0, (x_center - w / 2) * width)
+            y1 = max(0.0, (y_center - h / 2) * height)
+            x2 = min(float(width), (x_center + w / 2) * width)
+            y2 = min(float(height), (y_center + h / 2) * height)
+
+            results.append({
+                "dish_code": dish_code,
+                "dish_desc": DEFAULT_DISHES.get(dish_code, {}).get("dish_desc", dish_code),
+                "confidence": round(float(rng.uniform(conf_low, conf_high)), 2),
+                "bbox": [x1, y1, x2, y2],
+                "bbox_normalized": [
+                    round(x1/width, 3),
+                    round(y1/height, 3),
+                    round(x2/width, 3),
+                    round(y2/height, 3)
+                ]
+            })
+        return results
+
+    def _image_size(self, image_path: str) -> Tuple[int, int]:
+        """只读取文件头获取尺寸，无法解析时使用默认尺寸"""
+        info = probe_image_file(image_path)
+        if info is None:
+            return tuple(self.config["default_size"])
+        return info["width"], info["height"]
+
+    def _sample_latency(self, batch_size: int) -> float:
+        """按对数正态分布采样一个批次的耗时（秒）"""
+        lat_cfg = self.config["latency_ms"]
+        with self._timing_lock:
+            samples = self._timing_rng.lognormal(np.log(lat_cfg["median"]), lat_cfg["sigma"], size=batch_size)
+        samples = np.clip(samples, lat_cfg["min"], lat_cfg["max"])
+        total_ms = self.config["batch_overhead_ms"] + samples[0] + samples[1:].sum() * self.config["batch_efficiency"]
+        return total_ms / 1000.0
+
+    def _sample_cpu_fraction(self) -> float:
+        """按Beta分布采样一个批次耗时中占用CPU的比例"""
+        cpu_cfg = self.config["cpu_fraction"]
+        mean = min(max(cpu_cfg["mean"], 0.0), 1.0)
+        if mean in (0.0, 1.0) or cpu_cfg["concentration"] <= 0:
+            return mean
+        with self._timing_lock:
+            return float(self._timing_rng.beta(mean * cpu_cfg["concentration"],
+                                               (1 - mean) * cpu_cfg["concentration"]))
+
+    def _simulate_latency(self, batch_size: int, elapsed: float):
+        """按采样的CPU比例占用CPU，其余时间休眠（模拟等待加速器）"""
+        remaining = self._sample_latency(batch_size) - elapsed
+        if remaining <= 0:
+            return
+        cpu_time = remaining * self._sample_cpu_fraction()
+        self._burn(cpu_time)
+        time.sleep(remaining - cpu_time)
+
+    def _burn(self, seconds: float):
+        """执行矩阵运算占用CPU，numpy运算期间释放GIL，与真实推理线程行为接近"""
+        end = time.perf_counter() + seconds
+        a = self._burn_a
+        while time.perf_counter() < end:
+            a = np.tanh(a @ self._burn_a)
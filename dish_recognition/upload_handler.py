@@ -0,0 +1,317 @@
+"""
+上传处理模块
+负责上传图片的流式读取、校验和落盘
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import hashlib
+import json
+import struct
+from typing import Dict, Any, List, Optional, Tuple
+from config import UPLOAD_CONFIG
+
+
+class UploadRejected(Exception):
+    """上传文件校验失败"""
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+# 图片格式对应的扩展名
+FORMAT_EXTENSIONS = {
+    "jpeg": {".jpg", ".jpeg"},
+    "png": {".png"},
+    "bmp": {".bmp"},
+    "webp": {".webp"},
+}
+
+
+def detect_image_format(header: bytes) -> Optional[str]:
+    """根据文件头魔数判断图片格式"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"BM"):
+        return "bmp"
+    if len(header) >= 12 and header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """扫描JPEG段，从SOF段读取宽高"""
+    pos = 2
+    length = len(data)
+    while pos + 4 <= length:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        # 填充字节
+        if marker == 0xFF:
+            pos += 1
+            continue
+        # 无长度字段的标记
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        seg_len = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        # SOF0-SOF15（排除DHT、JPG、DAC）
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > length:
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + seg_len
+    return None
+
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """读取WEBP（VP8/VP8L/VP8X）的宽高"""
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        b0, b1, b2, b3 = data[21:25]
+        width = 1 + (((b1 & 0x3F) << 8) | b0)
+        height = 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+        return width, height
+    if chunk == b"VP8X":
+        width = 1 + int.from_bytes(data[24:27], "little")
+        height = 1 + int.from_bytes(data[27:30], "little")
+        return width, height
+    return None
+
+
+def read_image_size(image_format: str, header: bytes) -> Optional[Tuple[int, int]]:
+    """
+    从文件头解析图片宽高，无需完整解码
+    数据不足时返回None
+    """
+    if image_format == "jpeg":
+        return _jpeg_size(header)
+    if image_format == "png":
+        if len(header) < 24 or header[12:16] != b"IHDR":
+            return None
+        return struct.unpack(">II", header[16:24])
+    if image_format == "bmp":
+        if len(header) < 26:
+            return None
+        width, height = struct.unpack("<ii", header[18:26])
+        return abs(width), abs(height)
+    if image_format == "webp":
+        return _webp_size(header)
+    return None
+
+
+def probe_image_file(filepath: str) -> Optional[Dict[str, Any]]:
+    """读取本地图片文件头，返回格式与尺寸"""
+    with open(filepath, "rb") as f:
+        header = f.read(UPLOAD_CONFIG["header_probe_size"])
+    image_format = detect_image_format(header)
+    if image_format is None:
+        return None
+    size = read_image_size(image_format, header)
+    if size is None:
+        return None
+    return {"format": image_format, "width": size[0], "height": size[1]}
+
+
+def check_extension(filename: Optional[str]):
+    """校验客户端文件名扩展名"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext and ext not in UPLOAD_CONFIG["allowed_extensions"]:
+        raise UploadRejected(f"不支持的文件格式: {ext}", status_code=415)
+
+
+class UploadInspector:
+    """
+    增量校验上传内容
+    逐块喂入数据，累计哈希和大小，尽早发现超限或格式不符
+    """
+    def __init__(self):
+        self.max_size = UPLOAD_CONFIG["max_file_size"]
+        self.max_dimension = UPLOAD_CONFIG["max_image_dimension"]
+        self.probe_size = UPLOAD_CONFIG["header_probe_size"]
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.header = b""
+        self.image_format = None
+        self.width = None
+        self.height = None
+
+    def feed(self, chunk: bytes):
+        """处理一个数据块，不合规时抛出UploadRejected"""
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadRejected(
+                f"文件大小超过限制 {self.max_size // (1024 * 1024)}MB", status_code=413
+            )
+        self.hasher.update(chunk)
+
+        if self.width is None:
+            self.header += chunk[:self.probe_size - len(self.header)]
+            self._inspect_header(final=False)
+
+    def finish(self) -> Dict[str, Any]:
+        """数据读取完毕，返回上传信息"""
+        if self.size == 0:
+            raise UploadRejected("上传文件为空")
+        if self.width is None:
+            self._inspect_header(final=True)
+        return {
+            "sha256": self.hasher.hexdigest(),
+            "size": self.size,
+            "format": self.image_format,
+            "width": self.width,
+            "height": self.height,
+        }
+
+    def _inspect_header(self, final: bool):
+        if self.image_format is None:
+            if len(self.header) < 12 and not final:
+                return
+            self.image_format = detect_image_format(self.header)
+            if self.image_format is None:
+                raise UploadRejected("文件内容不是支持的图片格式", status_code=415)
+            allowed = UPLOAD_CONFIG["allowed_extensions"]
+            if not FORMAT_EXTENSIONS[self.image_format] & allowed:
+                raise UploadRejected(f"不支持的图片格式: {self.image_format}", status_code=415)
+
+        size = read_image_size(self.image_format, self.header)
+        if size is None:
+            if final or len(self.header) >= self.probe_size:
+                raise UploadRejected("无法解析图片尺寸")
+            return
+
+        self.width, self.height = size
+        if self.width <= 0 or self.height <= 0:
+            raise UploadRejected("图片尺寸无效")
+        if max(self.width, self.height) > self.max_dimension:
+            raise UploadRejected(
+                f"图片尺寸 {self.width}x{self.height} 超过限制 {self.max_dimension}", status_code=413
+            )
+        self.header = b""
+
+
+def extension_for(image_format: str) -> str:
+    """返回图片格式对应的保存扩展名"""
+    return ".jpg" if image_format == "jpeg" else f".{image_format}"
+
+
+class UploadSizeLimitMiddleware:
+    """
+    上传请求体大小限制（ASGI中间件）
+    在表单解析之前生效：Content-Length超限时直接返回413；
+    未声明长度或声明不实时，边接收边计数，超限后立即返回413并中止接收，
+    请求体不会被完整缓存
+    """
+    def __init__(self, app, paths: List[str], max_body_size: Optional[int] = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_body_size = max_body_size or (
+            UPLOAD_CONFIG["max_file_size"] + UPLOAD_CONFIG["max_form_overhead"]
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None:
+            try:
+                declared = int(content_length)
+            except ValueError:
+                declared = None
+            if declared is not None and declared > self.max_body_size:
+                await self._reject(send)
+                return
+
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    rejected = True
+                    await self._reject(send)
+                    # 让表单解析以客户端断开的方式结束
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            # 已返回413后丢弃应用自身的响应
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    async def _reject(self, send):
+        body = json.dumps(
+            {"detail": f"文件大小超过限制 {UPLOAD_CONFIG['max_file_size'] // (1024 * 1024)}MB"},
+            ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+async def save_upload(upload, directory: str, stem: str) -> Dict[str, Any]:
+    """
+    分块读取上传文件并写入磁盘
+    上传内容此时已由框架缓存在临时文件中（请求体大小由UploadSizeLimitMiddleware提前限制），
+    这里分块读取，不把整个文件读入内存；格式或尺寸不合规时立即中止并清理临时文件
+    返回包含保存路径、哈希、大小、格式和尺寸的字典
+    """
+    check_extension(upload.filename)
+
+    # 文件本身超限（表单其余部分很小）时直接拒绝
+    declared_size = getattr(upload, "size", None)
+    if declared_size is not None and declared_size > UPLOAD_CONFIG["max_file_size"]:
+        raise UploadRejected(
+            f"文件大小超过限制 {UPLOAD_CONFIG['max_file_size'] // (1024 * 1024)}MB", status_code=413
+        )
+
+    os.makedirs(directory, exist_ok=True)
+    inspector = UploadInspector()
+    tmp_path = os.path.join(directory, f".{stem}.part")
+    chunk_size = UPLOAD_CONFIG["chunk_size"]
+
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                inspector.feed(chunk)
+                f.write(chunk)
+        info = inspector.finish()
+        filepath = os.path.join(directory, stem + extension_for(info["format"]))
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    info["filepath"] = filepath
+    return info
@@ -31,6 +31,22 @@ def create_test_image():
     
     return img_bytes
 
+# 创建随机图案的训练图片，避免被感知哈希判为近似重复
+def create_training_image():
+    img = Image.new('RGB', (400, 400), color='white')
+    draw = ImageDraw.Draw(img)
+    seed = uuid.uuid4().int
+    for i in range(12):
+        x, y = (seed >> (i * 8)) % 320, (seed >> (i * 8 + 4)) % 320
+        color = ((seed >> i) % 256, (seed >> (i + 7)) % 256, (seed >> (i + 13)) % 256)
+        draw.rectangle([x, y, x + 80, y + 80], fill=color)
+    
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='JPEG')
+    img_bytes.seek(0)
+    
+    return img_bytes
+
 # 测试API
 def test_api():
     # 创建测试图片
@@ -47,10 +63,52 @@ def test_api():
         if response.status_code == 200:
             result = response.json()
             print(f"识别结果: {json.dumps(result, indent=2, ensure_ascii=False)}")
+            image_id = result["image_id"]
         else:
             print(f"识别API错误: {response.text}")
+            image_id = None
     except Exception as e:
         print(f"识别API请求失败: {e}")
+        image_id = None
+    
+    # 测试标注图
+    if image_id:
+        print("\n测试标注图API...")
+        try:
+            response = requests.get(
+                f"http://localhost:8000/annotated/{image_id}",
+                params={"variant": "thumb", "format": "webp"}
+            )
+            print(f"标注图响应状态: {response.status_code}")
+            if response.status_code == 200:
+                print(f"标注图类型: {response.headers.get('content-type')}, 大小: {len(response.content)} 字节")
+            else:
+                print(f"标注图API错误: {response.text}")
+        except Exception as e:
+            print(f"标注图API请求失败: {e}")
+    
+    # 测试添加训练数据：先新建菜品，再为同一菜品补充图片
+    print("\n测试添加训练数据API...")
+    dish_code = f"T{uuid.uuid4().hex[:8].upper()}"
+    try:
+        for expected_new in (True, False):
+            response = requests.post(
+                "http://localhost:8000/add_training_data/",
+                files={"image": ("train.jpg", create_training_image(), "image/jpeg")},
+                data={"dish_code": dish_code, "dish_desc": "测试菜品", "category": "测试"}
+            )
+            print(f"添加训练数据响应状态: {response.status_code}")
+            if response.status_code != 200:
+                print(f"添加训练数据API错误: {response.text}")
+                break
+            new_dish = response.json().get("new_dish")
+            status = "✓" if new_dish == expected_new else "✗"
+            print(f"   {status} new_dish={new_dish}（预期 {expected_new}）")
+        response = requests.get("http://localhost:8000/dishes/")
+        codes = {d["dish_code"] for d in response.json().get("dishes", [])}
+        print(f"   {'✓' if dish_code in codes else '✗'} 菜品列表包含新菜品 {dish_code}")
+    except Exception as e:
+        print(f"添加训练数据API请求失败: {e}")
     
     # 测试健康检查
     print("\n测试健康检查API...")
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+"""
+组件离线测试
+不依赖运行中的服务和模型权重，验证各组件的行为
+可直接运行，也可用pytest执行
+"""
+import os
+import sys
+import io
+import struct
+import zlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "dish_recognition"))
+
+from PIL import Image
+
+
+def image_bytes(fmt: str = "PNG", size=(64, 48), color=(200, 30, 30)) -> bytes:
+    """生成测试图片的字节内容"""
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def png_header(width: int, height: int) -> bytes:
+    """只包含IHDR块的PNG文件头，用于构造超大尺寸图片"""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    chunk = b"IHDR" + ihdr
+    return b"\x89PNG\r\n\x1a\n" + struct.pack(">I", len(ihdr)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+
+def inspect(data: bytes, chunk_size: int = 4096, **overrides):
+    """分块喂入数据并返回校验结果"""
+    from upload_handler import UploadInspector
+    inspector = UploadInspector()
+    for key, value in overrides.items():
+        setattr(inspector, key, value)
+    for start in range(0, len(data), chunk_size):
+        inspector.feed(data[start:start + chunk_size])
+    return inspector.finish()
+
+
+def expect_rejected(data: bytes, status_code: int, **overrides):
+    """校验应以指定状态码拒绝"""
+    from upload_handler import UploadRejected
+    try:
+        inspect(data, **overrides)
+    except UploadRejected as e:
+        assert e.status_code == status_code, f"状态码 {e.status_code}，预期 {status_code}: {e.message}"
+        return e
+    raise AssertionError(f"未被拒绝，预期状态码 {status_code}")
+
+
+def test_upload_inspector():
+    """上传校验：正常图片通过，各类不合规内容按对应状态码拒绝"""
+    info = inspect(image_bytes("PNG", (64, 48)))
+    assert (info["format"], info["width"], info["height"]) == ("png", 64, 48)
+    # 逐字节喂入时结果一致
+    info = inspect(image_bytes("JPEG", (30, 20)), chunk_size=1)
+    assert (info["format"], info["width"], info["height"]) == ("jpeg", 30, 20)
+
+    expect_rejected(b"", 400)
+    expect_rejected(b"not an image at all", 415)
+    expect_rejected(image_bytes("PNG"), 413, max_size=100)
+    expect_rejected(png_header(9000, 10), 413)
+    expect_rejected(png_header(0, 10), 400)
+    # 没有SOF段的JPEG无法解析尺寸
+    expect_rejected(b"\xff\xd8\xff\xe0\x00\x04ab" + b"\x00" * 32, 400)
+
+
+def run_middleware(headers, chunks, max_body_size=100):
+    """用模拟的ASGI应用调用上传大小限制中间件，返回(响应状态码, 应用读取的字节数)"""
+    import asyncio
+    from upload_handler import UploadSizeLimitMiddleware
+
+    read = []
+
+    async def app(scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            read.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/recognize/", "headers": headers}
+    middleware = UploadSizeLimitMiddleware(app, paths=["/recognize/"], max_body_size=max_body_size)
+    asyncio.run(middleware(scope, receive, send))
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    return status, sum(len(b) for b in read)
+
+
+def test_upload_size_limit_middleware():
+    """上传大小限制在表单解析之前生效"""
+    # 声明长度超限时不读取请求体
+    assert run_middleware([(b"content-length", b"1000")], [b"x" * 1000]) == (413, 0)
+    # 未声明长度时边接收边计数，超限后中止
+    status, read = run_middleware([], [b"x" * 60, b"x" * 60, b"x" * 60])
+    assert status == 413 and read <= 60
+    assert run_middleware([(b"content-length", b"50")], [b"x" * 50]) == (200, 50)
+
+
+def test_scheduler_priority_and_deadline():
+    """调度器：高优先级先执行，排队中超过截止时间的任务不执行且不占用队列容量"""
+    import asyncio
+    import time
+    from scheduler import InferenceScheduler, DeadlineExceeded, deadline_from_header
+
+    async def scenario():
+        scheduler = InferenceScheduler()
+        scheduler.max_queue_size = 3
+        order = []
+        # 第一个任务占住工作线程，之后的任务在队列中按优先级排序
+        busy = asyncio.ensure_future(scheduler.submit(time.sleep, 0.2))
+        await asyncio.sleep(0.02)
+        jobs = [
+            asyncio.ensure_future(scheduler.submit(order.append, name, priority=name))
+            for name in ("low", "normal", "high")
+        ]
+        await asyncio.gather(busy, *jobs)
+        assert order == ["high", "normal", "low"], order
+
+        busy = asyncio.ensure_future(scheduler.submit(time.sleep, 0.2))
+        await asyncio.sleep(0.02)
+        ran = []
+        expiring = [
+            scheduler.submit(ran.append, i, priority="low", deadline=time.monotonic() + 0.02)
+            for i in range(3)
+        ]
+        results = await asyncio.gather(*expiring, return_exceptions=True)
+        assert all(isinstance(r, DeadlineExceeded) for r in results), results
+        # 超时的任务已从排队计数中扣除，队列未满
+        assert scheduler.get_stats()["queue_length"] == 0
+        assert await scheduler.submit(lambda: "done", priority="high") == "done"
+        await busy
+        await asyncio.sleep(0.02)
+        assert ran == []
+        stats = scheduler.get_stats()["priorities"]["low"]
+        assert (stats["expired"], stats["queued"], stats["completed"]) == (3, 0, 1), stats
+
+    asyncio.run(scenario())
+
+    assert deadline_from_header(None) is None
+    for value in ("nan", "inf", "-5", "abc"):
+        assert deadline_from_header(value) is None, value
+    assert deadline_from_header("100") > time.monotonic()
+
+
+def test_synthetic_backend_determinism():
+    """合成后端：相同图片内容始终得到相同结果，耗时采样可复现"""
+    import tempfile
+    from synthetic_backend import SyntheticBackend
+
+    def backend():
+        b = SyntheticBackend()
+        # 不模拟耗时，测试只关心检测结果
+        b.config = dict(b.config, latency_ms={"median": 0.01, "sigma": 0.0, "min": 0.0, "max": 0.01},
+                        batch_overhead_ms=0.0)
+        return b
+
+    tmp_dir = tempfile.mkdtemp()
+    paths = []
+    for i, color in enumerate([(200, 30, 30), (200, 30, 30), (30, 200, 30)]):
+        path = os.path.join(tmp_dir, f"{i}.png")
+        with open(path, "wb") as f:
+            f.write(image_bytes("PNG", (320, 240), color))
+        paths.append(path)
+
+    first, second = backend(), backend()
+    results = first.predict_batch(paths)
+    assert results == second.predict_batch(paths)
+    assert results[0] == results[1], "相同内容的图片结果应一致"
+    assert results[0] != results[2]
+    for detections in results:
+        assert 1 <= len(detections) <= first.config["detections"]["max"]
+        for det in detections:
+            x1, y1, x2, y2 = det["bbox"]
+            assert 0 <= x1 < x2 <= 320 and 0 <= y1 < y2 <= 240
+            assert all(type(v) is float for v in det["bbox"] + det["bbox_normalized"])
+    assert first.predict_batch([]) == []
+
+    fractions = [backend()._sample_cpu_fraction() for _ in range(2)]
+    assert fractions[0] == fractions[1] and 0.0 < fractions[0] < 1.0
+
+
+def test_bk_tree_search():
+    """BK树查询结果与逐个比较一致"""
+    import random
+    from phash_index import BKTree, hamming_distance
+
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    # 加入若干近似重复和完全重复的哈希
+    hashes += [h ^ (1 << rng.randrange(64)) for h in hashes[:30]] + hashes[:5]
+    tree = BKTree()
+    for i, h in enumerate(hashes):
+        tree.add(h, f"img{i}")
+    assert tree.size == len(hashes)
+
+    for query in hashes[:40] + [rng.getrandbits(64) for _ in range(10)]:
+        for radius in (0, 3, 6, 20):
+            expected = sorted(
+                (hamming_distance(query, h), f"img{i}") for i, h in enumerate(hashes)
+                if hamming_distance(query, h) <= radius
+            )
+            assert tree.search(query, radius) == expected
+    assert BKTree().search(0, 10) == []
+
+
+def test_training_index_check_and_add():
+    """训练图片索引：近似重复在查重时被拒绝，移除后同一哈希可以重新加入"""
+    import tempfile
+    from config import DEDUP_CONFIG
+    from phash_index import TrainingImageIndex
+
+    tmp_dir = tempfile.mkdtemp()
+    original_path = DEDUP_CONFIG["index_path"]
+    DEDUP_CONFIG["index_path"] = os.path.join(tmp_dir, "phash.json")
+    try:
+        index = TrainingImageIndex(training_dir=tmp_dir)
+    finally:
+        DEDUP_CONFIG["index_path"] = original_path
+
+    paths = []
+    for name in ("a.png", "b.png"):
+        path = os.path.join(tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(image_bytes())
+        paths.append(path)
+
+    base = 0x0F0F0F0F0F0F0F0F
+    assert index.check_and_add(paths[0], base, skip_duplicates=True) == (True, [])
+    added, duplicates = index.check_and_add(paths[1], base ^ 0b11, skip_duplicates=True)
+    assert not added and duplicates == [{"filename": "a.png", "distance": 2}]
+    assert index.hash_of("b.png") is None
+
+    index.remove("a.png")
+    assert index.check_and_add(paths[1], base ^ 0b11, skip_duplicates=True) == (True, [])
+
+
+def test_model_registry_budget():
+    """模型注册表：并发首次请求只加载一次，内存占用增长后按LRU淘汰"""
+    import threading
+    import time
+    from model_registry import ModelRegistry
+
+    class FakeModel:
+        def __init__(self, model_id):
+            self.model_id = model_id
+            self.footprint = 40
+
+        def memory_footprint(self):
+            return self.footprint
+
+    loads = []
+
+    def fake_load(model_id):
+        loads.append(model_id)
+        time.sleep(0.05)
+        model = FakeModel(model_id)
+        return model, model.memory_footprint()
+
+    registry = ModelRegistry()
+    registry.memory_budget = 100
+    registry._load = fake_load
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("a"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loads == ["a"] and len({id(m) for m in results}) == 1
+
+    model_a = registry.get("a")
+    registry.get("b")
+    assert [m["model_id"] for m in registry.get_stats()["loaded"]] == ["a", "b"]
+    # 加载后新增的参考向量使a的占用增长，再次检查预算时淘汰最久未使用的a
+    model_a.footprint = 90
+    registry.get("b")
+    assert [m["model_id"] for m in registry.get_stats()["loaded"]] == ["b"]
+    assert registry.stats["evictions"] == 1
+
+
+def test_embedding_index_per_model():
+    """向量索引按模型分开保存，参考向量增长计入内存占用"""
+    import tempfile
+    from config import EMBEDDING_CONFIG
+    from embedding_index import create_matcher
+
+    tmp_dir = tempfile.mkdtemp()
+    original = dict(EMBEDDING_CONFIG)
+    EMBEDDING_CONFIG.update(index_dir=tmp_dir, extractor="histogram")
+    try:
+        path = os.path.join(tmp_dir, "ref.png")
+        with open(path, "wb") as f:
+            f.write(image_bytes())
+        matcher_a = create_matcher("canteen_a")
+        assert matcher_a.index.memory_bytes() == 0
+        matcher_a.add_reference(path, "D0001")
+        assert len(matcher_a.index) == 1 and matcher_a.index.memory_bytes() > 0
+
+        assert len(create_matcher("canteen_b").index) == 0
+        reloaded = create_matcher("canteen_a")
+        assert len(reloaded.index) == 1
+        assert reloaded.index.reference_images() == [(path, "D0001")]
+    finally:
+        EMBEDDING_CONFIG.clear()
+        EMBEDDING_CONFIG.update(original)
+
+
+def test_rolling_window_rollover():
+    """滚动窗口：时间前进时清空过期的桶，合计与逐桶计数保持一致"""
+    from dish_stats import RollingWindow
+
+    window = RollingWindow(bucket_seconds=60, num_buckets=4, capacity=1)
+    window.add(0, 100)
+    window.add(0, 100)
+    window.add(0, 101, count=3)
+    assert window.series(0) == [0, 0, 2, 3] and window.current(0) == 3
+    assert int(window.totals[0]) == 5
+
+    # 扩容后已有计数保留
+    window.ensure_capacity(3)
+    window.add(2, 102)
+    assert window.series(0) == [0, 2, 3, 0] and window.series(2) == [0, 0, 0, 1]
+
+    # 前进两个桶，100号桶仍在窗口内
+    window.advance(104)
+    assert window.series(0) == [3, 0, 0, 0] and int(window.totals[0]) == 3
+    # 早于窗口的记录直接忽略
+    window.add(0, 100)
+    assert int(window.totals[0]) == 3
+
+    # 前进超过整个窗口时全部清空
+    window.advance(110)
+    assert window.series(0) == [0, 0, 0, 0] and int(window.totals.sum()) == 0
+
+
+def test_dish_stats_local_time():
+    """餐次和按天分桶使用同一本地时间，夏令时前后一致"""
+    import time
+    import calendar
+    if not hasattr(time, "tzset"):
+        return
+    from dish_stats import DishStats
+
+    original_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "America/New_York"
+    time.tzset()
+    try:
+        # 冬令时 12:30 EST = 17:30 UTC，夏令时 12:30 EDT = 16:30 UTC
+        for utc in ((2026, 1, 15, 17, 30, 0), (2026, 7, 15, 16, 30, 0)):
+            ts = calendar.timegm(utc)
+            local, lt = DishStats.local_seconds(ts)
+            assert lt.tm_hour == 12
+            assert int(local % 86400) == 12 * 3600 + 30 * 60
+    finally:
+        if original_tz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = original_tz
+        time.tzset()
+
+
+if __name__ == "__main__":
+    print("开始组件离线测试...")
+    failed = 0
+    tests = [(name, func) for name, func in list(globals().items()) if name.startswith("test_") and callable(func)]
+    for name, func in tests:
+        try:
+            func()
+            print(f"   ✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"   ✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n组件测试完成：{len(tests) - failed} 通过，{failed} 失败")
+    sys.exit(1 if failed else 0)